@@ -327,6 +327,16 @@ def install_req():
                  .format(req_file='requirements.txt'))
 
 
+@task
+def setup_bot():
+    logger.info("Creating tables and setting the Telegram webhook.")
+
+    with cd(DEPLOY_DIR), prefix('source %s' % VENV_ACTIVATE):
+        with settings(sudo_user=DEPLOYMENT_USER):
+            sudo('source {postactivate} && python -m steepshot_bot.main setup'
+                 .format(postactivate=os.path.join(VENV_BIN_DIR, 'postactivate')))
+
+
 @task
 def clean_pyc():
     logger.info("Cleaning .pyc files.")
@@ -413,4 +423,6 @@ def deploy():
 
     clean_pyc()
 
+    setup_bot()
+
     restart()
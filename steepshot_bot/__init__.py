@@ -0,0 +1,4 @@
+import time
+
+# Lets steepshot_bot.main report how long importing the bot took
+IMPORT_STARTED = time.time()
@@ -0,0 +1,335 @@
+"""
+asyncio entry point, run with UPDATE_MODE=aio:
+
+    python -m steepshot_bot.aio
+
+The webhook handler, feed requests and sending feed pages do not block: they use
+aiohttp clients for the Telegram Bot API and the Steepshot API. All other updates
+(logging in, posting, voting, commenting) run the regular handlers of
+steepshot_bot.main on a thread pool, so blocking Steem signing and broadcasting
+only ever holds one of its threads.
+"""
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import telebot
+from aiohttp import web
+from peewee import DoesNotExist
+from telebot.apihelper import ApiException
+
+from steepshot_bot import keyboard as kb, settings, stats, dedup, feeds, delivery, file_ids, users, sender, \
+    steepshot_api, conversation, seen
+from steepshot_bot import main as bot_main, db
+from steepshot_bot.messages import get_message
+from steepshot_bot.utils import resolve_identifier
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_URL = 'https://api.telegram.org/bot{0}/{1}'
+
+FEED_BUTTONS = {
+    kb.FEED_BTN: 'recent',
+    kb.NEW_BTN: 'new',
+    kb.HOT_BTN: 'hot',
+    kb.TOP_BTN: 'top'
+}
+
+# Every blocking call holds a pooled connection, more threads than the pool leaves
+# for them would only wait for one
+_executor = ThreadPoolExecutor(max_workers=min(
+    settings.AIO_BLOCKING_WORKERS,
+    settings.DATABASE_MAX_CONNECTIONS - settings.DATABASE_BACKGROUND_CONNECTIONS))
+
+
+def run_blocking(func, *args):
+    """Runs a blocking call on the thread pool and returns an awaitable of its result"""
+    return asyncio.get_event_loop().run_in_executor(_executor, db.call_with_connection, func, *args)
+
+
+class TelegramClient(object):
+    """Bot API client paced by the shared send scheduler and retried on 429."""
+
+    def __init__(self, session: aiohttp.ClientSession, token: str, timeout: float = 30):
+        self.session = session
+        self.token = token
+        self.timeout = timeout
+        self.timings = stats.Timings()
+
+    async def call(self, method: str, chat_id=None, **params):
+        if chat_id is not None:
+            params['chat_id'] = chat_id
+        payload = {}
+        for name, value in params.items():
+            if value is None:
+                continue
+            if hasattr(value, 'to_json'):
+                value = json.loads(value.to_json())
+            payload[name] = value
+
+        attempt = 0
+        while True:
+            delay = sender.scheduler.reserve(chat_id)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            start = time.time()
+            try:
+                with aiohttp.Timeout(self.timeout):
+                    async with self.session.post(TELEGRAM_API_URL.format(self.token, method), json=payload) as resp:
+                        result = await resp.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                self.timings[method].add(time.time() - start, error=True)
+                raise ApiException(str(e), method, None)
+            self.timings[method].add(time.time() - start, error=not result.get('ok'))
+            if result.get('ok'):
+                return result['result']
+            retry_after = result.get('parameters', {}).get('retry_after')
+            if resp.status != 429 or attempt >= settings.SEND_RETRIES:
+                raise ApiException(result.get('description'), method, resp)
+            attempt += 1
+            logger.warning('Too many requests to chat %s, retry in %ss', chat_id, retry_after)
+            sender.scheduler.pause(chat_id, retry_after or 1)
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> telebot.types.Message:
+        return telebot.types.Message.de_json(await self.call('sendMessage', chat_id, text=text, **kwargs))
+
+    async def send_photo(self, chat_id: int, photo: str, **kwargs) -> telebot.types.Message:
+        return telebot.types.Message.de_json(await self.call('sendPhoto', chat_id, photo=photo, **kwargs))
+
+    async def answer_callback_query(self, callback_query_id: str, **kwargs):
+        return await self.call('answerCallbackQuery', callback_query_id=callback_query_id, **kwargs)
+
+
+class SteepshotClient(object):
+    """Async counterpart of the feed requests in steepshot_api, sharing its urls, timeouts and stats."""
+
+    def __init__(self, session: aiohttp.ClientSession):
+        self.session = session
+
+    async def get_posts(self, feed: str, username: str, offset: str = None, limit: int = None) -> list:
+        endpoint = 'posts_' + feed
+        timeout = settings.STEEPSHOT_API_TIMEOUTS.get(endpoint, settings.STEEPSHOT_API_TIMEOUTS['default'])
+        params = {name: str(value) for name, value in steepshot_api.feed_params(username, offset, limit).items() if value}
+        start = time.time()
+        try:
+            with aiohttp.Timeout(sum(timeout)):
+                async with self.session.get(steepshot_api.API_URLS[endpoint], params=params) as resp:
+                    data = await resp.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            steepshot_api.timings[endpoint].add(time.time() - start, error=True)
+            logger.error('Failed to retrieve data from api: %s', e)
+            return []
+        steepshot_api.timings[endpoint].add(time.time() - start, error=resp.status >= 500)
+        return data.get('results', [])
+
+
+class AsyncBot(object):
+    """
+    Handles webhook updates as tasks. Updates of one chat run one after another,
+    at most AIO_MAX_UPDATES updates are in progress at once.
+    """
+
+    def __init__(self, telegram: TelegramClient, steepshot: SteepshotClient, max_updates: int):
+        self.telegram = telegram
+        self.steepshot = steepshot
+        self.max_updates = max_updates
+        self.latency = stats.Timing()
+        self._in_progress = 0
+        self._tails = {}
+        self._refreshing = {}
+
+    def submit(self, data: dict) -> bool:
+        """False if too many updates are in progress"""
+        if self._in_progress >= self.max_updates:
+            return False
+        update = telebot.types.Update.de_json(data)
+        key = bot_main.get_update_chat_id(update)
+        self._in_progress += 1
+        task = asyncio.ensure_future(self._run(self._tails.get(key), update))
+        self._tails[key] = task
+        task.add_done_callback(lambda t: self._done(key, t))
+        return True
+
+    def _done(self, key, task):
+        self._in_progress -= 1
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def _run(self, previous, update: telebot.types.Update):
+        if previous:
+            await asyncio.wait([previous])
+        start = time.time()
+        try:
+            await self.handle(update)
+        except Exception as e:
+            self.latency.add(time.time() - start, error=True)
+            logger.exception('Failed to handle update %s: %s', update.update_id, e)
+        else:
+            self.latency.add(time.time() - start)
+
+    async def handle(self, update: telebot.types.Update):
+        message = update.message
+        # Users in the middle of a dialog are answered by its handler
+        if message and message.content_type == 'text' and message.text in FEED_BUTTONS \
+                and not await run_blocking(conversation.has_state, message):
+            try:
+                user = await run_blocking(users.get_user, message.from_user.id)
+            except DoesNotExist:
+                user = None
+            if user and user.name:
+                users.touch(user)
+                await self.show_posts(message, FEED_BUTTONS[message.text], user.name)
+                return
+        await run_blocking(bot_main.process_update, update)
+
+    async def get_posts(self, feed: str, username: str, offset: str = None) -> list:
+        key = feeds.get_cache_key(feed, username, offset)
+        posts, fresh = feeds.cache.peek(key)
+        if posts is not None and fresh:
+            return posts
+        # One request per key at a time, stale posts are served while it runs
+        if key not in self._refreshing:
+            self._refreshing[key] = asyncio.ensure_future(self._fetch(key))
+        if posts is not None:
+            return posts
+        return await asyncio.shield(self._refreshing[key])
+
+    async def _fetch(self, key: tuple) -> list:
+        try:
+            posts = await self.steepshot.get_posts(*key, limit=settings.FEED_PAGE_SIZE + 1)
+            feeds.cache.put(key, posts)
+            return posts
+        finally:
+            del self._refreshing[key]
+
+    async def get_unseen_page(self, feed: str, username: str, seen_posts, offset: str = None):
+        """Async counterpart of feeds.get_unseen_page()"""
+        page = []
+        for _ in range(settings.FEED_SEEN_MAX_PAGES):
+            posts, next_offset = feeds.make_page(await self.get_posts(feed, username, offset), offset)
+            full_offset = feeds.fill_page(page, posts, seen_posts)
+            if full_offset:
+                return page, full_offset
+            if not next_offset:
+                return page, None
+            offset = next_offset
+        return page, offset
+
+    async def show_posts(self, message: telebot.types.Message, feed: str, username: str):
+        chat_id = message.chat.id
+        user_id = message.from_user.id
+        lang = message.from_user.language_code
+        page, next_offset = await self.get_unseen_page(feed, username, await run_blocking(seen.get_filter, user_id))
+        more_markup = None
+        if next_offset:
+            more_markup = kb.Keyboard.more(await run_blocking(feeds.save_cursor, feed, next_offset))
+        if not page:
+            await self.telegram.send_message(
+                chat_id,
+                get_message('no_new_photos' if next_offset else 'no_photos', locale=lang).format(source=message.text),
+                parse_mode='markdown',
+                reply_markup=more_markup
+            )
+            return
+        if next_offset:
+            asyncio.ensure_future(self.prefetch(feed, username, next_offset))
+        sent = []
+        try:
+            with delivery.timings['aio'].time():
+                for post in page:
+                    sent.append((post, await self.send_post(chat_id, post)))
+        finally:
+            await run_blocking(delivery.save_posts, chat_id, sent)
+            await run_blocking(seen.add, user_id, [resolve_identifier(post['url']) for post, _ in sent])
+        # The "More" button is handled by steepshot_bot.main
+        if next_offset:
+            await self.telegram.send_message(chat_id, get_message('more_posts', locale=lang), reply_markup=more_markup)
+
+    async def prefetch(self, feed: str, username: str, offset: str):
+        page, _ = feeds.make_page(await self.get_posts(feed, username, offset), offset)
+        await run_blocking(feeds.warm_page, page)
+        feeds.cache.prefetched += 1
+
+    async def send_post(self, chat_id: int, post: dict) -> telebot.types.Message:
+        url = post['body']
+        kwargs = {
+            'caption': delivery.get_caption(post),
+            'reply_markup': kb.Keyboard.post(post['url'], resolve_identifier(post['url']))
+        }
+        file_id = await run_blocking(file_ids.cache.get, url)
+        if file_id:
+            try:
+                return await self.telegram.send_photo(chat_id, file_id, **kwargs)
+            except ApiException as e:
+                if not file_ids.is_file_id_error(e):
+                    raise
+                logger.warning('Cached file_id for "%s" was rejected: %s', url, e)
+                await run_blocking(file_ids.cache.discard, url)
+        msg = await self.telegram.send_photo(chat_id, url, **kwargs)
+        await run_blocking(file_ids.remember, url, msg)
+        return msg
+
+    def as_dict(self) -> dict:
+        return {
+            'in_progress': self._in_progress,
+            'latency': self.latency.as_dict(),
+            'telegram': self.telegram.timings.as_dict()
+        }
+
+
+async def webhook(request: web.Request) -> web.Response:
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not data:
+        return web.Response(status=403)
+    update_id = data.get('update_id')
+    if await run_blocking(dedup.deduplicator.is_duplicate, update_id):
+        logger.info('Dropped redelivered update %s', update_id)
+        return web.Response(text='!')
+    if not request.app['bot'].submit(data):
+        logger.error('Too many updates in progress, asking Telegram to redeliver update %s', update_id)
+        await run_blocking(dedup.deduplicator.forget, update_id)
+        return web.Response(status=503)
+    return web.Response(text='!')
+
+
+async def stats_view(request: web.Request) -> web.Response:
+    return web.json_response(stats.collect(), dumps=lambda data: json.dumps(data, default=str))
+
+
+async def index(request: web.Request) -> web.Response:
+    return web.Response(text='!')
+
+
+async def on_startup(app: web.Application):
+    session = aiohttp.ClientSession(loop=app.loop)
+    app['session'] = session
+    app['bot'] = AsyncBot(TelegramClient(session, settings.TELEGRAM_BOT_TOKEN), SteepshotClient(session),
+                          settings.AIO_MAX_UPDATES)
+    stats.register('aio', app['bot'].as_dict)
+
+
+async def on_cleanup(app: web.Application):
+    app['session'].close()
+
+
+def create_app(loop: asyncio.AbstractEventLoop = None) -> web.Application:
+    app = web.Application(loop=loop or asyncio.get_event_loop())
+    app.router.add_post(settings.WEBHOOK_URL_PATH, webhook)
+    app.router.add_get(settings.WEBHOOK_URL_PATH + 'stats', stats_view)
+    app.router.add_get('/', index)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == '__main__':
+    if settings.UPDATE_MODE != 'aio':
+        raise SystemExit('Set UPDATE_MODE=aio to run the asyncio server')
+    bot_main.start()
+    web.run_app(create_app(), host=settings.AIO_HOST, port=settings.AIO_PORT)
@@ -0,0 +1,105 @@
+import datetime
+import logging
+
+from peewee import fn
+
+from steepshot_bot import settings, stats, steepshot_api
+from steepshot_bot.db import AnalyticsEvent, connection, get_db
+from steepshot_bot.workers import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+NEW_POST = 'post'
+UPVOTE = 'upvote'
+
+
+def log_new_post(username: str, error_occured: str = None):
+    AnalyticsEvent.create(kind=NEW_POST, username=username, error=error_occured)
+
+
+def log_upvote_post(identifier: str, username: str, error_occured: str = None):
+    AnalyticsEvent.create(kind=UPVOTE, username=username, identifier=identifier, error=error_occured)
+
+
+def _send(event: AnalyticsEvent):
+    if event.kind == NEW_POST:
+        steepshot_api.log_new_post(event.username, event.error)
+    elif event.kind == UPVOTE:
+        steepshot_api.log_upvote_post(event.identifier, event.username, event.error)
+    else:
+        logger.error('Unknown analytics event "%s" dropped.', event.kind)
+
+
+def _claim(now: datetime.datetime) -> list:
+    """
+    Takes up to ANALYTICS_BATCH_SIZE due events for ANALYTICS_CLAIM_TIMEOUT seconds by
+    moving their next attempt, so the senders of other processes skip them meanwhile.
+    """
+    due = [event.id for event in AnalyticsEvent
+           .select(AnalyticsEvent.id)
+           .where(AnalyticsEvent.next_attempt_at <= now)
+           .order_by(AnalyticsEvent.id)
+           .limit(settings.ANALYTICS_BATCH_SIZE)]
+    claimed_until = now + datetime.timedelta(seconds=settings.ANALYTICS_CLAIM_TIMEOUT)
+    claimed = []
+    # One row per query, a row claimed by another process meanwhile is not updated
+    with get_db().atomic():
+        for event_id in due:
+            if AnalyticsEvent.update(next_attempt_at=claimed_until).where(
+                    AnalyticsEvent.id == event_id, AnalyticsEvent.next_attempt_at <= now).execute():
+                claimed.append(event_id)
+    if not claimed:
+        return []
+    return list(AnalyticsEvent.select().where(AnalyticsEvent.id.in_(claimed)).order_by(AnalyticsEvent.id))
+
+
+@connection()
+def send_pending():
+    """
+    Sends due events in batches of ANALYTICS_BATCH_SIZE, claimed first so every process
+    can run it. Sent events are deleted with one query per batch, failed ones are
+    retried with exponential backoff.
+    """
+    while True:
+        now = datetime.datetime.now()
+        batch = _claim(now)
+        if not batch:
+            return
+
+        done, failed = [], 0
+        for event in batch:
+            try:
+                _send(event)
+                done.append(event.id)
+            except Exception as e:
+                failed += 1
+                event.attempts += 1
+                if event.attempts >= settings.ANALYTICS_MAX_ATTEMPTS:
+                    logger.error('Dropping analytics event %s after %s attempts: %s', event.id, event.attempts, e)
+                    done.append(event.id)
+                    continue
+                delay = settings.ANALYTICS_RETRY_BACKOFF * 2 ** (event.attempts - 1)
+                event.next_attempt_at = now + datetime.timedelta(seconds=delay)
+                event.save()
+        if done:
+            AnalyticsEvent.delete().where(AnalyticsEvent.id.in_(done)).execute()
+        if failed:
+            logger.warning('Failed to send %s analytics events, will retry.', failed)
+            return
+
+
+@connection()
+def as_dict() -> dict:
+    depth, oldest = AnalyticsEvent.select(fn.COUNT(AnalyticsEvent.id), fn.MIN(AnalyticsEvent.created_at)).scalar(
+        as_tuple=True)
+    if isinstance(oldest, str):
+        # SQLite returns aggregated dates as strings
+        oldest = datetime.datetime.strptime(oldest[:19], '%Y-%m-%d %H:%M:%S')
+    return {
+        'depth': depth,
+        'oldest_age': (datetime.datetime.now() - oldest).total_seconds() if oldest else 0
+    }
+
+
+sender = PeriodicTask('analytics', settings.ANALYTICS_SEND_INTERVAL, send_pending)
+stats.register('analytics', as_dict)
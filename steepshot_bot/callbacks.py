@@ -0,0 +1,70 @@
+"""
+Inline button callback data carrying the post identifier, so callbacks
+do not need to look the post up in the database.
+
+Format: "<action code>:<author>/<permlink>:<signature>", at most 64 bytes.
+Older messages use "<action>" or "<action>:<message id>" which are resolved
+through the Post table.
+"""
+import base64
+import hashlib
+import hmac
+import re
+
+from steepshot_bot import settings
+
+MAX_LENGTH = 64
+
+ACTIONS = {
+    'upvote': 'u',
+    'comment': 'c'
+}
+_ACTION_NAMES = {code: name for name, code in ACTIONS.items()}
+_LEGACY_RE = re.compile(r'^({})(?::(\d+))?$'.format('|'.join(ACTIONS)))
+
+
+def _sign(code: str, identifier: str) -> str:
+    digest = hmac.new(settings.CALLBACK_SECRET.encode(), '{}:{}'.format(code, identifier).encode(),
+                      hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:6]).decode()
+
+
+def encode(action: str, identifier: str):
+    """Returns None if the identifier does not fit into callback data."""
+    code = ACTIONS[action]
+    identifier = identifier.lstrip('@')
+    data = '{}:{}:{}'.format(code, identifier, _sign(code, identifier))
+    if len(data.encode()) > MAX_LENGTH:
+        return None
+    return data
+
+
+def fits(identifier: str) -> bool:
+    return all(encode(action, identifier) for action in ACTIONS)
+
+
+def get_action(data: str) -> str:
+    action = data.partition(':')[0]
+    return _ACTION_NAMES.get(action, action)
+
+
+def decode(data: str):
+    """Returns the post identifier or None for legacy or invalid callback data."""
+    parts = data.split(':')
+    if len(parts) != 3 or parts[0] not in _ACTION_NAMES:
+        return None
+    code, identifier, signature = parts
+    if not hmac.compare_digest(signature, _sign(code, identifier)):
+        return None
+    return '@' + identifier
+
+
+def get_legacy_message_id(data: str, default: int = None):
+    """
+    Returns the message id of legacy callback data, default if it has none.
+    Raises ValueError for anything else, e.g. data whose signature does not match.
+    """
+    match = _LEGACY_RE.match(data)
+    if not match:
+        raise ValueError('Invalid callback data: "{}"'.format(data))
+    return int(match.group(2)) if match.group(2) else default
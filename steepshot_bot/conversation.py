@@ -0,0 +1,167 @@
+import datetime
+import json
+import logging
+import threading
+
+import telebot
+from peewee import DoesNotExist
+
+from steepshot_bot import settings, sharding
+from steepshot_bot.cache import LRUCache
+from steepshot_bot.db import Conversation, connection
+from steepshot_bot.workers import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+
+
+class MemoryStore(object):
+    """Keeps conversations in this process only."""
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int):
+        with self._lock:
+            return self._states.get(user_id)
+
+    def set(self, user_id: int, state: str, data: dict):
+        with self._lock:
+            self._states[user_id] = (state, data, datetime.datetime.now())
+
+    def pop(self, user_id: int):
+        with self._lock:
+            return self._states.pop(user_id, None)
+
+    def purge(self, cutoff: datetime.datetime):
+        with self._lock:
+            for user_id, (_, _, updated_at) in list(self._states.items()):
+                if updated_at < cutoff:
+                    del self._states[user_id]
+
+
+def owns_users() -> bool:
+    """
+    True if no other process handles updates of the users this process handles:
+    polling and aio run in one process, ShardRouter sends each user to one worker.
+    """
+    return settings.UPDATE_MODE != 'webhook' or sharding.is_worker()
+
+
+class DatabaseStore(object):
+    """
+    Keeps conversations in the database, shared by all worker processes.
+    If `cache` is set, lookups including users without a dialog are cached for
+    CONVERSATION_CACHE_TTL seconds, so most messages do not read the database.
+    Only processes which own their users (see owns_users()) may cache them.
+    """
+
+    def __init__(self, cache: bool = None):
+        if cache is None:
+            cache = owns_users()
+        self._cache = LRUCache(settings.CONVERSATION_CACHE_SIZE, settings.CONVERSATION_CACHE_TTL) if cache else None
+
+    def get(self, user_id: int):
+        if self._cache is None:
+            return self._load(user_id)
+        conversation = self._cache.get(user_id, self)
+        if conversation is self:
+            conversation = self._load(user_id)
+            self._cache.set(user_id, conversation)
+        return conversation
+
+    def _load(self, user_id: int):
+        try:
+            conversation = Conversation.get(Conversation.user_id == user_id)
+        except DoesNotExist:
+            return None
+        return conversation.state, json.loads(conversation.data), conversation.updated_at
+
+    def set(self, user_id: int, state: str, data: dict):
+        updated_at = datetime.datetime.now()
+        fields = {'state': state, 'data': json.dumps(data), 'updated_at': updated_at}
+        updated = Conversation.update(**fields).where(Conversation.user_id == user_id).execute()
+        if not updated:
+            Conversation.create(user_id=user_id, **fields)
+        if self._cache is not None:
+            self._cache.set(user_id, (state, data, updated_at))
+
+    def pop(self, user_id: int):
+        """
+        Claims the dialog: of processes popping it at once only one gets it, the
+        others get None, so its next step is never run twice.
+        """
+        if self._cache is not None:
+            if self._cache.get(user_id, self) is None:
+                return None
+            self._cache.set(user_id, None)
+        conversation = self._load(user_id)
+        if conversation is None:
+            return None
+        # Also does not remove a dialog set again since it was loaded
+        deleted = Conversation.delete().where(
+            Conversation.user_id == user_id,
+            Conversation.updated_at == conversation[2]
+        ).execute()
+        return conversation if deleted == 1 else None
+
+    @connection()
+    def purge(self, cutoff: datetime.datetime):
+        Conversation.delete().where(Conversation.updated_at < cutoff).execute()
+
+
+STORES = {
+    'memory': MemoryStore,
+    'db': DatabaseStore
+}
+
+store = STORES[settings.CONVERSATION_STORE]()
+
+
+def handler(state: str):
+    """Registers func(message, **data) called with the next message of a user in this state."""
+
+    def decorator(func):
+        _handlers[state] = func
+        return func
+
+    return decorator
+
+
+def set_state(user_id: int, state: str, **data):
+    """data must be JSON serializable"""
+    if state not in _handlers:
+        raise ValueError('No handler for conversation state "%s"' % state)
+    store.set(user_id, state, data)
+
+
+def clear(user_id: int):
+    store.pop(user_id)
+
+
+def is_expired(updated_at: datetime.datetime) -> bool:
+    return datetime.datetime.now() - updated_at > datetime.timedelta(seconds=settings.CONVERSATION_TTL)
+
+
+def purge_expired():
+    store.purge(datetime.datetime.now() - datetime.timedelta(seconds=settings.CONVERSATION_TTL))
+
+
+purger = PeriodicTask('conversations', settings.CONVERSATION_PURGE_INTERVAL, purge_expired)
+
+
+def has_state(message: telebot.types.Message) -> bool:
+    conversation = store.get(message.from_user.id)
+    return bool(conversation) and not is_expired(conversation[2])
+
+
+def dispatch(message: telebot.types.Message):
+    """Runs the handler of the user's state once, handlers set the next state themselves."""
+    conversation = store.pop(message.from_user.id)
+    if not conversation or is_expired(conversation[2]):
+        return
+    state, data, _ = conversation
+    logger.info('Continue conversation "%s" of user %s', state, message.from_user.id)
+    return _handlers[state](message, **data)
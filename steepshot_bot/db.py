@@ -1,15 +1,49 @@
 import datetime
+import functools
 import logging
 import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
 
 from peewee import *
 from playhouse.db_url import connect
+from playhouse.pool import MaxConnectionsExceeded
 
-from steepshot_bot import settings
+from steepshot_bot import settings, stats
 from steepshot_bot.utils import Object
 
 logger = logging.getLogger(__name__)
 db = None
+_db_lock = threading.Lock()
+checkout_wait = stats.Timing()
+
+# Pause between attempts to take a connection from an exhausted pool
+CHECKOUT_RETRY_DELAY = 0.05
+# Identifier batches of prune_posts() failing on concurrent inserts before it gives up
+PRUNE_CONFLICT_ATTEMPTS = 5
+
+
+def get_pooled_url(url: str) -> str:
+    """Selects the pooled database class of playhouse.db_url, e.g. postgres:// becomes postgres+pool://"""
+    scheme, rest = url.split('://', 1)
+    if not scheme.endswith('+pool'):
+        scheme += '+pool'
+    return '{}://{}'.format(scheme, rest)
+
+
+def _connect(url: str):
+    if not settings.DATABASE_POOL:
+        return connect(url)
+    kwargs = {}
+    if url.startswith('sqlite'):
+        # Pooled connections are handed from thread to thread
+        kwargs['check_same_thread'] = False
+    return connect(get_pooled_url(url),
+                   max_connections=settings.DATABASE_MAX_CONNECTIONS,
+                   stale_timeout=settings.DATABASE_STALE_TIMEOUT,
+                   **kwargs)
 
 
 def get_db():
@@ -18,18 +52,102 @@ def get_db():
     if db:
         return db
 
+    with _db_lock:
+        if db:
+            return db
+        try:
+            if settings.DEBUG:
+                logger.info('Connecting to SQLite database.')
+                db = _connect(settings.SQLITE_DATABASE_URL)
+            else:
+                logger.info('Connecting to PostgreSQL database.')
+                db = _connect(os.getenv('DATABASE_URL', ''))
+
+            return db
+        except OperationalError as e:
+            logger.error('Failed to connect to database: %s', e)
+            raise ConnectionError
+
+
+class LazyDatabase(Proxy):
+    """Database of the models, created by get_db() when a query is first run rather than on import."""
+
+    def __getattr__(self, attr):
+        if self.obj is None:
+            self.initialize(get_db())
+        return getattr(self.obj, attr)
+
+
+database_proxy = LazyDatabase()
+
+
+@contextmanager
+def connection():
+    """
+    Opens a connection of the current thread, taken from the pool, and closes it at
+    the end of the block, which returns it to the pool. Nested blocks and threads
+    already holding a connection keep using it. Also usable as a decorator.
+
+    Waits up to DATABASE_POOL_TIMEOUT seconds while all pooled connections are in
+    use, then raises MaxConnectionsExceeded. Nothing has been run at that point,
+    so the caller can safely try again later.
+    """
+    database = get_db()
+    if not database.is_closed():
+        yield database
+        return
+    start = time.time()
+    while True:
+        try:
+            database.connect()
+            break
+        except MaxConnectionsExceeded:
+            # Waited here rather than by the pool, peewee 2 pools do not wait
+            if time.time() - start >= settings.DATABASE_POOL_TIMEOUT:
+                checkout_wait.add(time.time() - start, error=True)
+                raise
+            time.sleep(CHECKOUT_RETRY_DELAY)
+        except Exception:
+            checkout_wait.add(time.time() - start, error=True)
+            raise
+    checkout_wait.add(time.time() - start)
     try:
-        if settings.DEBUG:
-            logger.info('Connecting to SQLite database.')
-            db = connect(settings.SQLITE_DATABASE_URL)
-        else:
-            logger.info('Connecting to PostgreSQL database.')
-            db = connect(os.getenv('DATABASE_URL', ''))
+        yield database
+    finally:
+        if not database.is_closed():
+            database.close()
 
-        return db
-    except OperationalError as e:
-        logger.error('Failed to connect to database: %s', e)
-        raise ConnectionError
+
+def call_with_connection(func, *args):
+    """
+    Calls func inside connection(), taking a connection up to DATABASE_CHECKOUT_ATTEMPTS
+    times while the pool stays exhausted. Calls made while holding a connection never
+    raise MaxConnectionsExceeded, so func has not started when it is tried again.
+    """
+    for attempt in range(1, settings.DATABASE_CHECKOUT_ATTEMPTS + 1):
+        try:
+            with connection():
+                return func(*args)
+        except MaxConnectionsExceeded:
+            if attempt == settings.DATABASE_CHECKOUT_ATTEMPTS:
+                raise
+            logger.warning('Database pool is exhausted, trying again (%s/%s)',
+                           attempt, settings.DATABASE_CHECKOUT_ATTEMPTS)
+
+
+def as_dict() -> dict:
+    result = {'checkout': checkout_wait.as_dict()}
+    # Pool internals are the same in peewee 2 and 3
+    if db is not None and hasattr(db, '_in_use'):
+        result.update({
+            'max_connections': settings.DATABASE_MAX_CONNECTIONS,
+            'in_use': len(db._in_use),
+            'idle': len(db._connections)
+        })
+    return result
+
+
+stats.register('database', as_dict)
 
 
 class User(Model):
@@ -41,16 +159,317 @@ class User(Model):
     last_login_time = DateTimeField(default=datetime.datetime.now)
 
     class Meta:
-        database = get_db()
+        database = database_proxy
 
     def get_wif_msg(self):
         return Object(chat=Object(id=self.chat_id), message_id=self.wif_message_id)
 
 
+class Identifier(Model):
+    value = CharField(max_length=512, unique=True)
+
+    class Meta:
+        database = database_proxy
+
+
 class Post(Model):
+    chat_id = IntegerField(default=-1)
+    message_id = IntegerField(default=-1)
+    identifier = ForeignKeyField(Identifier)
+    created_at = DateTimeField(default=datetime.datetime.now, index=True)
+
+    class Meta:
+        database = database_proxy
+        db_table = 'post_message'
+        indexes = (
+            (('chat_id', 'message_id'), True),
+        )
+
+
+class LegacyPost(Model):
+    """Post table of older versions, moved into Post in batches by migrate_legacy_posts()"""
     chat_id = IntegerField(default=-1)
     message_id = IntegerField(default=-1)
     identifier = CharField(default='')
 
     class Meta:
-        database = get_db()
+        database = database_proxy
+        db_table = 'post'
+
+
+class ImageFile(Model):
+    url = CharField(max_length=1024, unique=True)
+    file_id = CharField(default='')
+    last_used = DateTimeField(default=datetime.datetime.now, index=True)
+
+    class Meta:
+        database = database_proxy
+
+
+class AnalyticsEvent(Model):
+    kind = CharField()
+    username = CharField(default='')
+    identifier = CharField(max_length=512, default='')
+    error = TextField(null=True)
+    created_at = DateTimeField(default=datetime.datetime.now)
+    attempts = IntegerField(default=0)
+    next_attempt_at = DateTimeField(default=datetime.datetime.now, index=True)
+
+    class Meta:
+        database = database_proxy
+
+
+class Conversation(Model):
+    user_id = IntegerField(primary_key=True)
+    state = CharField()
+    data = TextField(default='{}')
+    updated_at = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        database = database_proxy
+
+
+class SeenPosts(Model):
+    """Bloom filters of posts shown to a user, see steepshot_bot.seen"""
+    user_id = IntegerField(primary_key=True)
+    data = BlobField()
+    updated_at = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        database = database_proxy
+
+
+class HandledUpdate(Model):
+    """update_ids received by any webhook process, see steepshot_bot.dedup"""
+    update_id = BigIntegerField(primary_key=True)
+    received_at = DateTimeField(default=datetime.datetime.now, index=True)
+
+    class Meta:
+        database = database_proxy
+
+
+class TaskLease(Model):
+    """Process running a task of which one should run at a time, see exclusive()"""
+    name = CharField(max_length=64, primary_key=True)
+    owner = CharField()
+    expires_at = DateTimeField()
+
+    class Meta:
+        database = database_proxy
+
+
+class FeedCursor(Model):
+    """Feed and offset of a "More" button, shared by all processes"""
+    token = CharField(max_length=32, primary_key=True)
+    feed = CharField()
+    offset = CharField(max_length=1024)
+    created_at = DateTimeField(default=datetime.datetime.now, index=True)
+
+    class Meta:
+        database = database_proxy
+
+
+def create_tables():
+    for model in (User, Identifier, Post, ImageFile, AnalyticsEvent, Conversation, SeenPosts, FeedCursor,
+                  HandledUpdate, TaskLease):
+        if not model.table_exists():
+            logger.info('Creating new table: "%s"', model.__name__.lower())
+            model.create_table()
+
+
+def get_identifier_ids(values) -> dict:
+    """Returns ids of the identifier strings by value, inserting the missing ones."""
+    values = set(values)
+    ids = {}
+    while True:
+        missing = values - set(ids)
+        ids.update(Identifier.select(Identifier.value, Identifier.id).where(Identifier.value.in_(missing)).tuples())
+        missing = values - set(ids)
+        if not missing:
+            return ids
+        try:
+            with get_db().atomic():
+                Identifier.insert_many([{'value': value} for value in missing]).execute()
+        except IntegrityError:
+            # Some were inserted by another process meanwhile, looked up again
+            pass
+
+
+def _insert_posts(rows: list):
+    ids = get_identifier_ids(identifier for _, _, identifier in rows)
+    Post.insert_many([
+        {'chat_id': chat_id, 'message_id': message_id, 'identifier': ids[identifier]}
+        for chat_id, message_id, identifier in rows
+    ]).execute()
+
+
+def add_posts(rows: list):
+    """rows is a list of (chat_id, message_id, identifier string)"""
+    if not rows:
+        return
+    for attempt in range(2):
+        try:
+            # A savepoint inside a caller's transaction, which stays usable after a failure
+            with get_db().atomic():
+                _insert_posts(rows)
+            return
+        except IntegrityError:
+            if attempt:
+                raise
+            # An identifier was pruned by prune_posts() after it was looked up,
+            # _insert_posts() looks them up again
+
+
+_legacy_posts_exist = None
+
+
+def legacy_posts_exist() -> bool:
+    """Whether the legacy post table is still there, checked in the database once per process"""
+    global _legacy_posts_exist
+
+    if _legacy_posts_exist is None:
+        _legacy_posts_exist = LegacyPost.table_exists()
+    return _legacy_posts_exist
+
+
+def find_post_identifier(chat_id: int, message_id: int) -> str:
+    """
+    Raises DoesNotExist
+    """
+    global _legacy_posts_exist
+
+    try:
+        return (Identifier
+                .select(Identifier.value)
+                .join(Post)
+                .where(Post.chat_id == chat_id, Post.message_id == message_id)
+                .get()).value
+    except DoesNotExist:
+        if not legacy_posts_exist():
+            raise
+        try:
+            return LegacyPost.get(LegacyPost.chat_id == chat_id, LegacyPost.message_id == message_id).identifier
+        except DatabaseError:
+            # Dropped by migrate_legacy_posts() of another process
+            _legacy_posts_exist = False
+            raise DoesNotExist('Legacy post table is gone')
+
+
+def migrate_legacy_posts(batch_size: int):
+    """Moves rows of the legacy post table into Post, one short transaction per batch."""
+    global _legacy_posts_exist
+
+    if not legacy_posts_exist():
+        return
+    while True:
+        with get_db().atomic():
+            batch = list(LegacyPost.select().order_by(LegacyPost.id).limit(batch_size))
+            if not batch:
+                break
+            existing = {
+                (p.chat_id, p.message_id) for p in
+                Post.select(Post.chat_id, Post.message_id).where(
+                    Post.message_id.in_([row.message_id for row in batch])
+                )
+            }
+            add_posts([
+                (row.chat_id, row.message_id, row.identifier) for row in batch
+                if (row.chat_id, row.message_id) not in existing
+            ])
+            LegacyPost.delete().where(LegacyPost.id.in_([row.id for row in batch])).execute()
+        logger.info('Moved %s rows from legacy post table.', len(batch))
+    LegacyPost.drop_table()
+    _legacy_posts_exist = False
+    logger.info('Legacy post table dropped.')
+
+
+def prune_posts(max_age: datetime.timedelta, batch_size: int):
+    """Deletes posts older than max_age and identifiers no longer referenced, batch by batch."""
+    cutoff = datetime.datetime.now() - max_age
+    removed = 0
+    while True:
+        batch = Post.select(Post.id).where(Post.created_at < cutoff).limit(batch_size)
+        count = Post.delete().where(Post.id.in_(batch)).execute()
+        removed += count
+        if count < batch_size:
+            break
+    unused = 0
+    conflicts = 0
+    while True:
+        # Finding and deleting unused identifiers is one statement, so no post can be
+        # added in between. A post added meanwhile by another transaction makes the
+        # batch fail, it is selected again without that identifier
+        batch = (Identifier.select(Identifier.id)
+                 .where(~fn.EXISTS(Post.select(Post.id).where(Post.identifier == Identifier.id)))
+                 .limit(batch_size))
+        try:
+            with get_db().atomic():
+                count = Identifier.delete().where(Identifier.id.in_(batch)).execute()
+        except IntegrityError as e:
+            conflicts += 1
+            if conflicts >= PRUNE_CONFLICT_ATTEMPTS:
+                logger.warning('Unused identifiers left for the next run, they keep being reused: %s', e)
+                break
+            continue
+        unused += count
+        if count < batch_size:
+            break
+    if unused:
+        logger.info('Removed %s unused identifiers.', unused)
+    if removed:
+        logger.info('Removed %s posts older than %s.', removed, max_age)
+
+
+LEASE_OWNER = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def acquire_lease(name: str, duration: float) -> bool:
+    """Takes or renews the lease `name` for this process, False while another one holds it"""
+    now = datetime.datetime.now()
+    expires_at = now + datetime.timedelta(seconds=duration)
+    if TaskLease.update(owner=LEASE_OWNER, expires_at=expires_at).where(
+            TaskLease.name == name, (TaskLease.owner == LEASE_OWNER) | (TaskLease.expires_at < now)).execute():
+        return True
+    try:
+        with get_db().atomic():
+            TaskLease.create(name=name, owner=LEASE_OWNER, expires_at=expires_at)
+    except IntegrityError:
+        return False
+    return True
+
+
+def exclusive(name: str, duration: float):
+    """
+    Decorator of periodic tasks run by one process at a time: calls are skipped unless
+    this process holds the lease `name`. Each call renews it for `duration` seconds,
+    so another process takes over that long after the holder stops.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with connection():
+                if not acquire_lease(name, duration):
+                    return None
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def save_feed_cursor(token: str, feed: str, offset: str):
+    fields = {'feed': feed, 'offset': offset, 'created_at': datetime.datetime.now()}
+    if not FeedCursor.update(**fields).where(FeedCursor.token == token).execute():
+        FeedCursor.create(token=token, **fields)
+
+
+def find_feed_cursor(token: str, max_age: datetime.timedelta):
+    """Returns (feed, offset) or None if there is no such cursor younger than max_age"""
+    try:
+        cursor = FeedCursor.get(FeedCursor.token == token,
+                                FeedCursor.created_at > datetime.datetime.now() - max_age)
+    except FeedCursor.DoesNotExist:
+        return None
+    return cursor.feed, cursor.offset
+
+
+def prune_feed_cursors(max_age: datetime.timedelta):
+    FeedCursor.delete().where(FeedCursor.created_at < datetime.datetime.now() - max_age).execute()
@@ -0,0 +1,99 @@
+import datetime
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from peewee import DatabaseError, IntegrityError
+
+from steepshot_bot import settings, stats
+from steepshot_bot.db import HandledUpdate, connection, exclusive
+from steepshot_bot.workers import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDeduplicator(object):
+    """
+    Remembers update_ids received in the last `ttl` seconds, at most `size` of them,
+    so updates redelivered by Telegram are handled once. If `shared` is set, the ids
+    are also recorded in the HandledUpdate table, so a redelivery reaching another
+    webhook process or a restarted one is dropped too.
+    """
+
+    def __init__(self, size: int, ttl: float, shared: bool = False):
+        self.size = size
+        self.ttl = ttl
+        self.shared = shared
+        self.dropped = 0
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float):
+        # Ids are kept in arrival order, so expired ones are at the front
+        while self._seen:
+            update_id, received = next(iter(self._seen.items()))
+            if now - received <= self.ttl and len(self._seen) <= self.size:
+                break
+            self._seen.popitem(last=False)
+
+    def _claim(self, update_id: int, now: float) -> bool:
+        """Records update_id in the table, False if another process already did"""
+        try:
+            with connection():
+                HandledUpdate.create(update_id=update_id, received_at=datetime.datetime.fromtimestamp(now))
+        except IntegrityError:
+            return False
+        except DatabaseError as e:
+            # Handling an update twice is better than dropping it
+            logger.error('Failed to record update %s: %s', update_id, e)
+        return True
+
+    def is_duplicate(self, update_id: int) -> bool:
+        """Records update_id and tells whether it was already seen in the window"""
+        now = time.time()
+        with self._lock:
+            if update_id in self._seen:
+                self.dropped += 1
+                return True
+        # Not remembered locally when claimed by another process, which may forget it
+        if self.shared and not self._claim(update_id, now):
+            with self._lock:
+                self.dropped += 1
+            return True
+        with self._lock:
+            self._seen[update_id] = now
+            self._expire(now)
+        return False
+
+    def forget(self, update_id: int):
+        """For updates that were not handled and should be accepted when redelivered"""
+        with self._lock:
+            self._seen.pop(update_id, None)
+        if not self.shared:
+            return
+        try:
+            with connection():
+                HandledUpdate.delete().where(HandledUpdate.update_id == update_id).execute()
+        except DatabaseError as e:
+            logger.error('Failed to forget update %s, its redelivery will be dropped: %s', update_id, e)
+
+    def prune(self):
+        """Deletes recorded ids older than the window, so the table stays small"""
+        if not self.shared:
+            return
+        cutoff = datetime.datetime.fromtimestamp(time.time() - self.ttl)
+        with connection():
+            HandledUpdate.delete().where(HandledUpdate.received_at < cutoff).execute()
+
+    def as_dict(self) -> dict:
+        return {
+            'size': len(self._seen),
+            'dropped': self.dropped
+        }
+
+
+deduplicator = UpdateDeduplicator(settings.UPDATE_DEDUP_SIZE, settings.UPDATE_DEDUP_TTL, shared=True)
+pruner = PeriodicTask('update-dedup', settings.UPDATE_DEDUP_PRUNE_INTERVAL,
+                      exclusive('update-dedup', 3 * settings.UPDATE_DEDUP_PRUNE_INTERVAL)(deduplicator.prune))
+stats.register('update_dedup', deduplicator.as_dict)
@@ -0,0 +1,100 @@
+import logging
+
+import telebot
+from telebot.apihelper import ApiException
+
+from steepshot_bot import keyboard as kb, settings, stats, file_ids, callbacks
+from steepshot_bot.db import add_posts, connection
+from steepshot_bot.utils import resolve_identifier
+
+logger = logging.getLogger(__name__)
+
+timings = stats.Timings()
+stats.register('feed_delivery', timings.as_dict)
+
+
+def get_caption(post: dict) -> str:
+    return '{}: {}'.format(post['author'], post['title'])
+
+
+@connection()
+def _send_post(bot: telebot.TeleBot, chat_id: int, post: dict) -> telebot.types.Message:
+    return file_ids.send_photo(
+        bot,
+        chat_id,
+        post['body'],
+        caption=get_caption(post),
+        reply_markup=kb.Keyboard.post(post['url'], resolve_identifier(post['url']))
+    )
+
+
+def _send_serial(bot: telebot.TeleBot, chat_id: int, posts: list) -> list:
+    sent = []
+    try:
+        for post in posts:
+            sent.append((post, _send_post(bot, chat_id, post)))
+    finally:
+        save_posts(chat_id, sent)
+    return sent
+
+
+def _send_album(bot: telebot.TeleBot, chat_id: int, posts: list) -> list:
+    """Sends the page as one album followed by a message with buttons for every post."""
+    if len(posts) < 2:
+        return _send_serial(bot, chat_id, posts)
+
+    def get_media(use_cache: bool):
+        return [
+            telebot.types.InputMediaPhoto(
+                (use_cache and file_ids.cache.get(post['body'])) or post['body'],
+                caption=get_caption(post)
+            )
+            for post in posts
+        ]
+
+    try:
+        messages = bot.send_media_group(chat_id, get_media(use_cache=True))
+    except ApiException as e:
+        if not file_ids.is_file_id_error(e):
+            raise
+        logger.warning('Album with cached file_ids was rejected, sending urls: %s', e)
+        for post in posts:
+            file_ids.cache.discard(post['body'])
+        messages = bot.send_media_group(chat_id, get_media(use_cache=False))
+
+    sent = list(zip(posts, messages))
+    for post, msg in sent:
+        file_ids.remember(post['body'], msg)
+    save_posts(chat_id, sent)
+
+    bot.send_message(
+        chat_id,
+        '\n'.join('{}. {}'.format(number, get_caption(post)) for number, post in enumerate(posts, 1)),
+        reply_markup=kb.Keyboard.album([
+            (post['url'], resolve_identifier(post['url']), msg.message_id) for post, msg in sent
+        ])
+    )
+    return sent
+
+
+def save_posts(chat_id: int, sent: list):
+    """Only posts whose identifier does not fit into callback data are looked up in the database."""
+    rows = []
+    for post, msg in sent:
+        identifier = resolve_identifier(post['url'])
+        if not callbacks.fits(identifier):
+            rows.append((chat_id, msg.message_id, identifier))
+    add_posts(rows)
+
+
+SENDERS = {
+    'serial': _send_serial,
+    'album': _send_album
+}
+
+
+def send_page(bot: telebot.TeleBot, chat_id: int, posts: list, mode: str = None) -> list:
+    """Returns a list of (post, sent message) tuples."""
+    mode = mode or settings.FEED_DELIVERY_MODE
+    with timings[mode].time():
+        return SENDERS[mode](bot, chat_id, posts)
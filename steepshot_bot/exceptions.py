@@ -11,6 +11,10 @@ class SteepshotServerError(SteepshotBotError):
     }
 
 
+class SteepshotConnectionError(SteepshotServerError):
+    pass
+
+
 class SteemError(SteepshotBotError):
     msg = {
         'en': 'Some Steem error occurred: '
@@ -27,3 +31,9 @@ class VotedSimilarily(SteepshotBotError):
     msg = {
         'en': 'You have already voted in a similar way: '
     }
+
+
+class ImageTooLarge(SteepshotBotError):
+    msg = {
+        'en': 'This photo is too large: '
+    }
@@ -0,0 +1,220 @@
+import datetime
+import hashlib
+import logging
+import threading
+import time
+
+from steepshot_bot import settings, stats, steepshot_api, file_ids, db
+from steepshot_bot.cache import LRUCache
+from steepshot_bot.utils import resolve_identifier
+from steepshot_bot.workers import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+FETCHERS = {
+    'recent': steepshot_api.get_recent_posts,
+    'new': steepshot_api.get_new_posts,
+    'hot': steepshot_api.get_hot_posts,
+    'top': steepshot_api.get_top_posts
+}
+
+# Feeds whose content depends on the user, all others are shared between users.
+# Shared feeds are requested without a username, so per-user fields of the posts
+# (e.g. whether the user voted) are missing. This is intended: feed pages only
+# show url, body, author and title, which are the same for everyone
+PERSONAL_FEEDS = {'recent'}
+
+
+class FeedCache(object):
+    """
+    Caches feed responses for `ttl` seconds. Entries younger than `ttl + stale_ttl`
+    are still served while one background refresh is running, concurrent misses
+    for the same key wait for a single upstream request.
+    """
+
+    def __init__(self, ttl: float, stale_ttl: float, max_size: int):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self._entries = LRUCache(max_size)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._refresher = WorkerPool('feed-refresh', 2)
+
+    def get(self, key, fetch):
+        entry = self._entries.get(key)
+        if entry:
+            fetched_at, posts = entry
+            age = time.time() - fetched_at
+            if age <= self.ttl:
+                self.hits += 1
+                return posts
+            if age <= self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._refresh_in_background(key, fetch)
+                return posts
+        self.misses += 1
+        return self._fetch(key, fetch, fallback=entry[1] if entry else [])
+
+    def peek(self, key):
+        """
+        For callers fetching on their own, e.g. with an async client. Returns (posts, fresh),
+        posts is None if there is nothing to serve.
+        """
+        entry = self._entries.get(key)
+        if entry:
+            fetched_at, posts = entry
+            age = time.time() - fetched_at
+            if age <= self.ttl:
+                self.hits += 1
+                return posts, True
+            if age <= self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                return posts, False
+        self.misses += 1
+        return None, False
+
+    def put(self, key, posts: list):
+        if posts:
+            self._entries.set(key, (time.time(), posts))
+
+    def _fetch(self, key, fetch, fallback: list) -> list:
+        with self._lock:
+            event = self._inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self._inflight[key] = threading.Event()
+        if not leader:
+            event.wait(settings.STEEPSHOT_API_TIMEOUTS['default'][1])
+            entry = self._entries.get(key)
+            return entry[1] if entry else fallback
+        try:
+            posts = fetch()
+            # Failed requests return an empty list, do not let them replace good data
+            if posts:
+                self._entries.set(key, (time.time(), posts))
+                return posts
+            return fallback
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+    def submit(self, func, *args):
+        """Runs func on the background refresh threads"""
+        self._refresher.submit(func, *args)
+
+    def _refresh_in_background(self, key, fetch):
+        with self._lock:
+            if key in self._inflight:
+                return
+        self._refresher.submit(self._fetch, key, fetch, [])
+
+    def as_dict(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'prefetched': self.prefetched,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses
+        }
+
+
+cache = FeedCache(settings.FEED_CACHE_TTL, settings.FEED_CACHE_STALE_TTL, settings.FEED_CACHE_SIZE)
+stats.register('feed_cache', cache.as_dict)
+
+
+cursors = LRUCache(settings.FEED_CURSOR_SIZE, settings.FEED_CURSOR_TTL)
+
+
+def get_cache_key(feed: str, username: str, offset: str = None) -> tuple:
+    return feed, username if feed in PERSONAL_FEEDS else None, offset
+
+
+def get_posts(feed: str, username: str, offset: str = None) -> list:
+    """Posts of one page and the post at offset if it is set"""
+    fetcher = FETCHERS[feed]
+    key = get_cache_key(feed, username, offset)
+    return cache.get(key, lambda: fetcher(key[1], offset, settings.FEED_PAGE_SIZE + 1))
+
+
+def make_page(posts: list, offset: str = None):
+    """Returns the posts of the page and the offset of the next page or None"""
+    if offset and posts and posts[0]['url'] == offset:
+        posts = posts[1:]
+    page = posts[:settings.FEED_PAGE_SIZE]
+    next_offset = page[-1]['url'] if len(page) == settings.FEED_PAGE_SIZE else None
+    return page, next_offset
+
+
+def get_page(feed: str, username: str, offset: str = None):
+    return make_page(get_posts(feed, username, offset), offset)
+
+
+def fill_page(page: list, posts: list, seen):
+    """
+    Adds posts not seen by the user to page until it is full. Returns the offset
+    to continue from if it is full, None otherwise.
+    """
+    for post in posts:
+        if resolve_identifier(post['url']) in seen:
+            continue
+        page.append(post)
+        if len(page) == settings.FEED_PAGE_SIZE:
+            return post['url']
+    return None
+
+
+def get_unseen_page(feed: str, username: str, seen, offset: str = None):
+    """Like get_page() but skips posts whose identifiers are in seen"""
+    page = []
+    for _ in range(settings.FEED_SEEN_MAX_PAGES):
+        posts, next_offset = get_page(feed, username, offset)
+        full_offset = fill_page(page, posts, seen)
+        if full_offset:
+            return page, full_offset
+        if not next_offset:
+            return page, None
+        offset = next_offset
+    return page, offset
+
+
+def save_cursor(feed: str, offset: str) -> str:
+    """
+    Returns a token short enough for callback data, get_cursor() resolves it to (feed, offset).
+    Cursors are stored in the database, so the button works in every process and after restarts.
+    """
+    token = hashlib.sha1('{}:{}'.format(feed, offset).encode()).hexdigest()[:12]
+    db.save_feed_cursor(token, feed, offset)
+    cursors.set(token, (feed, offset))
+    return token
+
+
+def get_cursor(token: str):
+    cursor = cursors.get(token)
+    if cursor is None:
+        cursor = db.find_feed_cursor(token, datetime.timedelta(seconds=settings.FEED_CURSOR_TTL))
+        if cursor is not None:
+            cursors.set(token, cursor)
+    return cursor
+
+
+@db.connection()
+def warm_page(posts: list):
+    """Loads file_ids of the page images into memory, so sending them does not wait for the database"""
+    for post in posts:
+        file_ids.cache.get(post['body'])
+
+
+def _prefetch(feed: str, username: str, offset: str):
+    page, _ = get_page(feed, username, offset)
+    warm_page(page)
+    cache.prefetched += 1
+
+
+def prefetch(feed: str, username: str, offset: str):
+    """Fetches and caches the page at offset in background"""
+    cache.submit(_prefetch, feed, username, offset)
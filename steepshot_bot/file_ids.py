@@ -0,0 +1,121 @@
+import datetime
+import logging
+import threading
+
+import telebot
+from peewee import DoesNotExist, IntegrityError
+from telebot.apihelper import ApiException
+
+from steepshot_bot import settings, stats
+from steepshot_bot.cache import LRUCache
+from steepshot_bot.db import ImageFile
+
+logger = logging.getLogger(__name__)
+
+# Prune the database table once per this many new rows
+PRUNE_EVERY = 100
+
+# Parts of Telegram error descriptions for file_ids which can not be sent any more
+FILE_ID_ERRORS = ('wrong file identifier', 'wrong remote file identifier', 'file reference')
+
+
+class FileIdCache(object):
+    """
+    Maps image URLs to Telegram file_ids. Recently used entries are kept in memory,
+    all of them are persisted in the database which is pruned to the
+    `db_size` most recently used rows.
+    """
+
+    def __init__(self, size: int, db_size: int):
+        self.db_size = db_size
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self._memory = LRUCache(size)
+        self._inserts = 0
+        self._lock = threading.Lock()
+
+    def get(self, url: str):
+        file_id = self._memory.get(url)
+        if file_id is None:
+            try:
+                image = ImageFile.get(ImageFile.url == url)
+                file_id = image.file_id
+                ImageFile.update(last_used=datetime.datetime.now()).where(ImageFile.id == image.id).execute()
+                self._memory.set(url, file_id)
+            except DoesNotExist:
+                pass
+        if file_id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return file_id
+
+    def set(self, url: str, file_id: str):
+        self._memory.set(url, file_id)
+        try:
+            ImageFile.create(url=url, file_id=file_id)
+        except IntegrityError:
+            ImageFile.update(file_id=file_id, last_used=datetime.datetime.now()).where(ImageFile.url == url).execute()
+            return
+        with self._lock:
+            self._inserts += 1
+            prune = self._inserts % PRUNE_EVERY == 0
+        if prune:
+            self.prune()
+
+    def discard(self, url: str):
+        self.rejected += 1
+        self._memory.pop(url)
+        ImageFile.delete().where(ImageFile.url == url).execute()
+
+    def prune(self):
+        keep = ImageFile.select(ImageFile.id).order_by(ImageFile.last_used.desc()).limit(self.db_size)
+        removed = ImageFile.delete().where(ImageFile.id.not_in(keep)).execute()
+        if removed:
+            logger.info('Removed %s least recently used image file_ids.', removed)
+
+    def as_dict(self) -> dict:
+        return {
+            'size': len(self._memory),
+            'hits': self.hits,
+            'misses': self.misses,
+            'rejected': self.rejected
+        }
+
+
+cache = FileIdCache(settings.FILE_ID_CACHE_SIZE, settings.FILE_ID_CACHE_DB_SIZE)
+stats.register('file_id_cache', cache.as_dict)
+
+
+def is_file_id_error(error: ApiException) -> bool:
+    """True if Telegram refused the file_id itself, not e.g. with 429 or a server error"""
+    response = getattr(error, 'result', None)
+    # requests and aiohttp responses
+    status = getattr(response, 'status_code', getattr(response, 'status', None))
+    if status != 400:
+        return False
+    message = str(error).lower().replace('_', ' ')
+    return any(part in message for part in FILE_ID_ERRORS)
+
+
+def send_photo(bot: telebot.TeleBot, chat_id: int, url: str, **kwargs) -> telebot.types.Message:
+    """Send a remote image reusing the Telegram file_id of an earlier send when possible."""
+    file_id = cache.get(url)
+    if file_id:
+        try:
+            return bot.send_photo(chat_id, file_id, **kwargs)
+        except ApiException as e:
+            if not is_file_id_error(e):
+                raise
+            logger.warning('Cached file_id for "%s" was rejected: %s', url, e)
+            cache.discard(url)
+    msg = bot.send_photo(chat_id, url, **kwargs)
+    remember(url, msg)
+    return msg
+
+
+def remember(url: str, msg: telebot.types.Message):
+    if msg.photo:
+        photo = sorted(msg.photo, key=lambda x: x.file_size or 0, reverse=True)[0]
+        cache.set(url, photo.file_id)
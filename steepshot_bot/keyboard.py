@@ -1,5 +1,7 @@
 import telebot
 
+from steepshot_bot import settings, callbacks
+
 LOG_IN_BTN = 'Log in'
 FEED_BTN = 'Feed'
 NEW_BTN = 'New'
@@ -8,6 +10,10 @@ TOP_BTN = 'Top'
 SETTINGS_BTN = 'Settings'
 BACK_BTN = 'Back'
 LOG_OUT_BTN = 'Log out'
+LIKE_BTN = b'\xE2\x9D\xA4'
+OPEN_BTN = 'open'
+COMMENT_BTN = 'comment'
+MORE_BTN = 'More'
 
 
 class Keyboard(object):
@@ -40,3 +46,38 @@ class Keyboard(object):
     @staticmethod
     def remove():
         return telebot.types.ReplyKeyboardRemove(selective=False)
+
+    @staticmethod
+    def post(post_url: str, identifier: str):
+        markup = telebot.types.InlineKeyboardMarkup()
+        markup.add(
+            telebot.types.InlineKeyboardButton(text=LIKE_BTN,
+                                               callback_data=callbacks.encode('upvote', identifier) or 'upvote'),
+            telebot.types.InlineKeyboardButton(text=OPEN_BTN, url=settings.POST_BASE_URL + post_url),
+            telebot.types.InlineKeyboardButton(text=COMMENT_BTN,
+                                               callback_data=callbacks.encode('comment', identifier) or 'comment')
+        )
+        return markup
+
+    @staticmethod
+    def more(token: str):
+        markup = telebot.types.InlineKeyboardMarkup()
+        markup.add(telebot.types.InlineKeyboardButton(text=MORE_BTN, callback_data='more:' + token))
+        return markup
+
+    @staticmethod
+    def album(posts: list):
+        """posts is a list of (post url, post identifier, message id of the album photo)"""
+        markup = telebot.types.InlineKeyboardMarkup()
+        for number, (post_url, identifier, message_id) in enumerate(posts, 1):
+            upvote_data = callbacks.encode('upvote', identifier) or 'upvote:%s' % message_id
+            comment_data = callbacks.encode('comment', identifier) or 'comment:%s' % message_id
+            markup.add(
+                telebot.types.InlineKeyboardButton(text='{} {}'.format(LIKE_BTN.decode(), number),
+                                                   callback_data=upvote_data),
+                telebot.types.InlineKeyboardButton(text='{} {}'.format(OPEN_BTN, number),
+                                                   url=settings.POST_BASE_URL + post_url),
+                telebot.types.InlineKeyboardButton(text='{} {}'.format(COMMENT_BTN, number),
+                                                   callback_data=comment_data)
+            )
+        return markup
@@ -1,40 +1,36 @@
 from peewee import DoesNotExist
 
-from steepshot_bot import steem, steepshot_api
-from steepshot_bot.db import User
-from steepshot_bot.exceptions import SteepshotServerError, SteemError
+from steepshot_bot import steem, steepshot_api, users, analytics
+from steepshot_bot.exceptions import SteepshotServerError, SteepshotConnectionError
 from steepshot_bot.utils import parse_hashtags
 
 
-def post_to_steem(
-        image_bytes: bytes,
+def prepare_post(
+        image,
         title_raw: str,
-        username: str):
+        username: str) -> dict:
+    """
+    image is bytes or a file object
+    raises (SteepshotServerError, SteepshotConnectionError)
+    """
     title, tags = parse_hashtags(title_raw)
-    data = steepshot_api.post_prepare(image_bytes, title, username, tags)
-    if not data or 'payload' not in data:
-        error_msg = ''
-        if data:
-            error_msg += ' '.join([v[0] for v in data.values()])
-        else:
-            error_msg = 'Failed to connect to Steepshot server'
-        raise SteepshotServerError(error_msg)
-    try:
-        steem.add_post_to_steem(data)
-        steepshot_api.log_new_post(username)
-    except SteemError as e:
-        steepshot_api.log_new_post(username, str(e))
+    data = steepshot_api.post_prepare(image, title, username, tags)
+    if not data:
+        raise SteepshotConnectionError('Failed to connect to Steepshot server')
+    if 'payload' not in data:
+        raise SteepshotServerError(' '.join([v[0] for v in data.values()]))
+    return data
 
 
 def upvote(identifier, username):
-    """raises (PostDoesNotExist, SteepshotServerError)"""
+    """raises (PostNotFound, VotedSimilarily)"""
     steem.upvote_post(identifier, username)
-    steepshot_api.log_upvote_post(identifier, username)
+    analytics.log_upvote_post(identifier, username)
 
 
 def is_authenticated(user_id):
     try:
-        User.get(User.id == user_id)
+        users.get_user(user_id)
         return True
     except DoesNotExist:
         return False
@@ -1,38 +1,58 @@
+import argparse
+import atexit
 import datetime
 import logging.config
 import os
+import queue
+import sys
+import threading
+import time
 from functools import wraps
 
 import telebot
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify
 from peewee import DoesNotExist
+from telebot.apihelper import ApiException
 from steepbase.exceptions import InvalidWifError
 from werkzeug.contrib.fixers import ProxyFix
 
-from steepshot_bot import keyboard as kb, settings, steem, steepshot_api, logic
-from steepshot_bot.db import User, Post
-from steepshot_bot.db import db
+from steepshot_bot import keyboard as kb, settings, steem, logic, stats, feeds, delivery, callbacks, users, nodes, posting, uploads, analytics, conversation, \
+    sharding, sender, dedup, polling, seen
+from steepshot_bot import db, IMPORT_STARTED
+from steepshot_bot.db import User
 from steepshot_bot.exceptions import SteepshotBotError
 from steepshot_bot.messages import get_message
 from steepshot_bot.utils import resolve_identifier
+from steepshot_bot.workers import KeyedDispatcher, PeriodicTask
 
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app)
 
-bot = telebot.TeleBot(settings.TELEGRAM_BOT_TOKEN)
+# Updates are handed to our own dispatcher, so telebot must run handlers inline
+bot = sender.ThrottledTeleBot(settings.TELEGRAM_BOT_TOKEN, threaded=False)
+
+post_pipeline = posting.create_pipeline(bot)
+
+dispatcher = KeyedDispatcher('updates', settings.UPDATE_WORKERS, settings.UPDATE_QUEUE_SIZE)
+stats.register('updates', dispatcher.as_dict)
+
+router = None
+if settings.UPDATE_PROCESSES and settings.UPDATE_MODE == 'webhook' and not sharding.is_worker():
+    router = sharding.ShardRouter(settings.UPDATE_PROCESSES, settings.UPDATE_PROCESS_QUEUE_SIZE)
+    stats.register('update_processes', router.as_dict)
 
 
 def authenticated(func):
     @wraps(func)
-    def wrapper(message: telebot.types.Message):
+    def wrapper(message: telebot.types.Message, *args, **kwargs):
         if isinstance(message, telebot.types.CallbackQuery):
             chat_id = message.message.chat.id
         else:
             chat_id = message.chat.id
         try:
-            user = User.get(User.id == message.from_user.id)
+            user = users.get_user(message.from_user.id)
             if not steem.is_user_logged_in(user.name):
                 msg = bot.reply_to(user.get_wif_msg(), 'Try to get your WIF key...')
                 wif = msg.reply_to_message.text
@@ -41,9 +61,9 @@ def authenticated(func):
                 user.last_login_time = datetime.datetime.now()
 
                 steem.login(user.name, wif)
-            user.last_action_time = datetime.datetime.now()
-            user.save()
-            return func(user, message)
+                user.save()
+            users.touch(user)
+            return func(user, message, *args, **kwargs)
         except DoesNotExist as e:
             logger.error('Not authenticated. User not found: %s', e)
             bot.send_message(
@@ -66,6 +86,12 @@ def authenticated(func):
     return wrapper
 
 
+# Must be registered first: a user in the middle of a dialog answers its question
+@bot.message_handler(func=conversation.has_state)
+def continue_conversation(message: telebot.types.Message):
+    conversation.dispatch(message)
+
+
 @bot.message_handler(commands=['start'])
 def handle_start(message: telebot.types.Message):
     lang = message.from_user.language_code
@@ -92,23 +118,24 @@ def handle_auth(message: telebot.types.Message):
         )
         return
 
-    msg = bot.reply_to(
+    bot.reply_to(
         message,
         get_message('username', locale=lang),
         parse_mode='markdown',
         reply_markup=kb.Keyboard.remove()
     )
-    bot.register_next_step_handler(msg, process_steem_username)
+    conversation.set_state(message.from_user.id, 'username')
 
 
+@conversation.handler('username')
 def process_steem_username(message: telebot.types.Message):
     lang = message.from_user.language_code
     steem_username = message.text
     logger.info('Try to authenticate Steem user: "%s"', steem_username)
     if not steem.account_exists(steem_username):
         logger.info('Steem acoount "%s" does not exists.', steem_username)
-        msg = bot.reply_to(message, get_message('user_not_found', locale=lang), parse_mode='markdown')
-        bot.register_next_step_handler(msg, process_steem_username)
+        bot.reply_to(message, get_message('user_not_found', locale=lang), parse_mode='markdown')
+        conversation.set_state(message.from_user.id, 'username')
         return
 
     try:
@@ -117,17 +144,19 @@ def process_steem_username(message: telebot.types.Message):
         user.name = steem_username
         user.chat_id = chat_id
         user.save()
+        users.invalidate(user.id)
         if created:
             logger.info('New user added to db: id=%s, name="%s"', message.from_user.id, steem_username)
         else:
             logger.info('user updated in db: id=%s, name="%s"', message.from_user.id, steem_username)
-        msg = bot.reply_to(message, get_message('wif', locale=lang), parse_mode='markdown')
-        bot.register_next_step_handler(msg, process_private_wif)
+        bot.reply_to(message, get_message('wif', locale=lang), parse_mode='markdown')
+        conversation.set_state(message.from_user.id, 'wif')
     except Exception as e:
         logger.error('Failed to process Steem username: %s', e)
         bot.reply_to(message, get_message('error', locale=lang))
 
 
+@conversation.handler('wif')
 def process_private_wif(message: telebot.types.Message):
     lang = message.from_user.language_code
 
@@ -140,6 +169,7 @@ def process_private_wif(message: telebot.types.Message):
 
         user.wif_message_id = message.message_id
         user.save()
+        users.invalidate(user.id)
 
         logger.info('User has been successfully registered and logged in: "%s"', user.name)
         bot.send_message(
@@ -176,68 +206,119 @@ def show_posts(user: User, message: telebot.types.Message):
     logger.info('Request posts for user: "%s"', user.name)
     lang = message.from_user.language_code
 
-    get_posts = {
-        kb.FEED_BTN: steepshot_api.get_recent_posts,
-        kb.NEW_BTN: steepshot_api.get_new_posts,
-        kb.HOT_BTN: steepshot_api.get_hot_posts,
-        kb.TOP_BTN: steepshot_api.get_top_posts
+    feed = {
+        kb.FEED_BTN: 'recent',
+        kb.NEW_BTN: 'new',
+        kb.HOT_BTN: 'hot',
+        kb.TOP_BTN: 'top'
     }[message.text]
-    posts = get_posts(user.name)
-    if not posts:
+    page, next_offset = feeds.get_unseen_page(feed, user.name, seen.get_filter(user.id))
+    if not page:
         bot.send_message(
             message.chat.id,
-            get_message('no_photos', locale=lang).format(source=message.text),
-            parse_mode='markdown'
+            get_message('no_new_photos' if next_offset else 'no_photos', locale=lang).format(source=message.text),
+            parse_mode='markdown',
+            reply_markup=kb.Keyboard.more(feeds.save_cursor(feed, next_offset)) if next_offset else None
         )
         return
-    for post in posts[:5]:
-        keyboard = telebot.types.InlineKeyboardMarkup()
-        like_button = telebot.types.InlineKeyboardButton(text=b'\xE2\x9D\xA4', callback_data='upvote')
-        url_button = telebot.types.InlineKeyboardButton(text='open', url=settings.POST_BASE_URL + post['url'])
-        comment_button = telebot.types.InlineKeyboardButton(text='comment', callback_data='comment')
-        keyboard.add(like_button, url_button, comment_button)
-        msg = bot.send_photo(
-            message.chat.id,
-            post['body'],
-            caption='{}: {}'.format(post['author'], post['title']),
-            reply_markup=keyboard
-        )
-        Post.create(chat_id=msg.chat.id, message_id=msg.message_id, identifier=resolve_identifier(post['url']))
+    send_feed_page(user, message.chat.id, lang, feed, page, next_offset)
 
 
-@bot.callback_query_handler(lambda call: call.data == 'comment')
+@bot.callback_query_handler(lambda call: callbacks.get_action(call.data) == 'more')
+@authenticated
+def more_callback(user: User, call: telebot.types.CallbackQuery):
+    lang = call.from_user.language_code
+    chat_id = call.message.chat.id
+    cursor = feeds.get_cursor(call.data.partition(':')[2])
+    if not cursor:
+        bot.answer_callback_query(call.id, get_message('page_expired', locale=lang), show_alert=True)
+        return
+    bot.answer_callback_query(call.id)
+    try:
+        bot.delete_message(chat_id, call.message.message_id)
+    except ApiException as e:
+        logger.warning('Failed to remove "More" button: %s', e)
+
+    feed, offset = cursor
+    page, next_offset = feeds.get_unseen_page(feed, user.name, seen.get_filter(user.id), offset)
+    if not page and next_offset:
+        # Only seen posts so far, the user may keep looking further
+        bot.send_message(chat_id, get_message('only_seen_posts', locale=lang),
+                         reply_markup=kb.Keyboard.more(feeds.save_cursor(feed, next_offset)))
+        return
+    if not page:
+        bot.send_message(chat_id, get_message('no_more_posts', locale=lang), reply_markup=kb.Keyboard.main())
+        return
+    send_feed_page(user, chat_id, lang, feed, page, next_offset)
+
+
+def send_feed_page(user: User, chat_id: int, lang: str, feed: str, page: list, next_offset: str = None):
+    if next_offset:
+        # Fetched while this page is being sent and looked at
+        feeds.prefetch(feed, user.name, next_offset)
+    sent = delivery.send_page(bot, chat_id, page)
+    seen.add(user.id, [resolve_identifier(post['url']) for post, _ in sent])
+    if next_offset:
+        bot.send_message(chat_id, get_message('more_posts', locale=lang),
+                         reply_markup=kb.Keyboard.more(feeds.save_cursor(feed, next_offset)))
+
+
+def get_callback_identifier(call: telebot.types.CallbackQuery) -> str:
+    """
+    Raises DoesNotExist
+    """
+    identifier = callbacks.decode(call.data)
+    if identifier:
+        return identifier
+    # Buttons of old messages are resolved through the Post table
+    try:
+        message_id = callbacks.get_legacy_message_id(call.data, call.message.message_id)
+    except ValueError as e:
+        # Signed with another secret or forged
+        logger.warning('%s', e)
+        raise DoesNotExist(str(e))
+    return db.find_post_identifier(call.message.chat.id, message_id)
+
+
+@bot.callback_query_handler(lambda call: callbacks.get_action(call.data) == 'comment')
 @authenticated
 def comment_callback(user: User, call: telebot.types.CallbackQuery):
     lang = call.message.from_user.language_code
     chat_id = call.message.chat.id
-    message_id = call.message.message_id
+    try:
+        identifier = get_callback_identifier(call)
+    except DoesNotExist:
+        logger.error('Failed to get post to comment.')
+        bot.answer_callback_query(call.id, 'Failed to get post to comment.', show_alert=True)
+        return
 
-    def request_comment_text(message: telebot.types.Message):
-        try:
-            post = Post.get(Post.chat_id == chat_id, Post.message_id == message_id)
-            steem.add_comment(post.identifier, user.name, message.text)
-            bot.send_message(chat_id,
-                             get_message('commented', locale=lang),
-                             parse_mode='markdown',
-                             reply_markup=kb.Keyboard.main())
-        except SteepshotBotError as e:
-            logger.error('Failed to get post to comment: %s', e)
-            bot.answer_callback_query(call.id, e.get_msg(locale=lang), show_alert=True)
+    bot.send_message(chat_id, 'Enter your comment to this post', reply_markup=telebot.types.ReplyKeyboardRemove())
+    conversation.set_state(call.from_user.id, 'comment', identifier=identifier)
 
-    msg = bot.send_message(chat_id, 'Enter your comment to this post', reply_markup=telebot.types.ReplyKeyboardRemove())
 
-    bot.register_next_step_handler(msg, request_comment_text)
+@conversation.handler('comment')
+@authenticated
+def request_comment_text(user: User, message: telebot.types.Message, identifier: str):
+    lang = message.from_user.language_code
+    chat_id = message.chat.id
+    try:
+        steem.add_comment(identifier, user.name, message.text)
+        bot.send_message(chat_id,
+                         get_message('commented', locale=lang),
+                         parse_mode='markdown',
+                         reply_markup=kb.Keyboard.main())
+    except SteepshotBotError as e:
+        logger.error('Failed to comment post: %s', e)
+        bot.send_message(chat_id, e.get_msg(locale=lang), parse_mode='markdown', reply_markup=kb.Keyboard.main())
 
 
-@bot.callback_query_handler(lambda call: call.data == 'upvote')
+@bot.callback_query_handler(lambda call: callbacks.get_action(call.data) == 'upvote')
 @authenticated
 def upvote_callback(user: User, call: telebot.types.CallbackQuery):
     lang = call.message.from_user.language_code
-    chat_id = call.message.chat.id
-    message_id = call.message.message_id
     try:
-        post = Post.get(Post.chat_id == chat_id, Post.message_id == message_id)
-        logic.upvote(post.identifier, user.name)
+        identifier = get_callback_identifier(call)
+        logic.upvote(identifier, user.name)
         # TODO update post
         bot.answer_callback_query(call.id, get_message('upvoted', locale=lang), show_alert=False)
     except SteepshotBotError as e:
@@ -282,6 +363,7 @@ def back_handler(user: User, message: telebot.types.Message):
     wif_msg = user.get_wif_msg()
     username = user.name
     steem.logout(user)
+    users.invalidate(user.id)
     logger.info('User %s has been successfully logged out.', username)
 
     bot.reply_to(
@@ -295,27 +377,77 @@ def back_handler(user: User, message: telebot.types.Message):
 @bot.message_handler(content_types=['photo'])
 @authenticated
 def post_image(user: User, message: telebot.types.Message):
-    lang = message.from_user.language_code
-    chat_id = message.chat.id
     title = message.caption
-    photo_info = sorted(message.photo, key=lambda x: x.file_size, reverse=True)[0]
-    file_info = bot.get_file(photo_info.file_id)
-    image_bytes = bot.download_file(file_info.file_path)
-
-    def post(msg: telebot.types.Message):
-        photo_title = title or msg.text
-        try:
-            logic.post_to_steem(image_bytes, photo_title, user.name)
-            bot.send_message(chat_id, get_message('post_added', locale=lang), parse_mode='markdown')
-        except SteepshotBotError as e:
-            logger.error('Failed to post photo: %s', e)
-            bot.send_message(chat_id, e.get_msg(lang), parse_mode='markdown')
+    photo_info = uploads.choose_photo_size(message.photo)
 
     if title:
-        post(message)
+        post_photo(user, message, photo_info.file_id, title)
     else:
-        m = bot.reply_to(message, get_message('title_required'), parse_mode='markdown')
-        bot.register_next_step_handler(m, post)
+        bot.reply_to(message, get_message('title_required'), parse_mode='markdown')
+        conversation.set_state(message.from_user.id, 'title', file_id=photo_info.file_id)
+
+
+@conversation.handler('title')
+@authenticated
+def request_photo_title(user: User, message: telebot.types.Message, file_id: str):
+    post_photo(user, message, file_id, message.text)
+
+
+def post_photo(user: User, message: telebot.types.Message, file_id: str, title: str):
+    lang = message.from_user.language_code
+    job = posting.PostJob(message.chat.id, user.name, lang, file_id, title)
+    status = bot.reply_to(message, get_message('post_queued', locale=lang), parse_mode='markdown')
+    job.status_message_id = status.message_id
+    post_pipeline.submit(job)
+
+
+def get_update_chat_id(update: telebot.types.Update):
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message:
+            return message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return update.update_id
+
+
+def get_update_user_id(update: telebot.types.Update):
+    for item in (update.message, update.edited_message, update.callback_query, update.inline_query,
+                 update.chosen_inline_result):
+        if item and item.from_user:
+            return item.from_user.id
+    return get_update_chat_id(update)
+
+
+def process_update(update: telebot.types.Update):
+    db.call_with_connection(bot.process_new_updates, [update])
+
+
+def handle_update_json(data: dict):
+    """Handles an update routed to this worker process, waits while the local queue is full"""
+    update = telebot.types.Update.de_json(data)
+    while True:
+        try:
+            dispatcher.submit(get_update_chat_id(update), process_update, update)
+            return
+        except queue.Full:
+            time.sleep(0.1)
+
+
+@db.exclusive('post-retention', 3 * settings.POST_RETENTION_INTERVAL)
+def maintain_posts():
+    db.migrate_legacy_posts(settings.POST_RETENTION_BATCH_SIZE)
+    db.prune_posts(datetime.timedelta(days=settings.POST_RETENTION_DAYS), settings.POST_RETENTION_BATCH_SIZE)
+    db.prune_feed_cursors(datetime.timedelta(seconds=settings.FEED_CURSOR_TTL))
+
+
+post_retention = PeriodicTask('post-retention', settings.POST_RETENTION_INTERVAL, maintain_posts)
+node_prober = PeriodicTask('steem-nodes', settings.STEEM_NODE_PROBE_INTERVAL, nodes.manager.probe, run_at_start=True)
+
+poller = polling.Poller(bot, dispatcher, process_update, get_update_chat_id,
+                        settings.POLLING_TIMEOUT, settings.POLLING_LIMIT)
+stats.register('polling', poller.as_dict)
 
 
 @app.route(settings.WEBHOOK_URL_PATH, methods=['POST'])
@@ -323,42 +455,120 @@ def webhook():
     data = request.get_json(silent=True)
     if not data:
         abort(403)
-    bot.process_new_updates([telebot.types.Update.de_json(data)])
+    update = telebot.types.Update.de_json(data)
+    if dedup.deduplicator.is_duplicate(update.update_id):
+        logger.info('Dropped redelivered update %s', update.update_id)
+        return "!", 200
+    try:
+        if router:
+            router.submit(get_update_user_id(update), data)
+        else:
+            dispatcher.submit(get_update_chat_id(update), process_update, update)
+    except queue.Full:
+        logger.error('Update queue is full, asking Telegram to redeliver update %s', update.update_id)
+        dedup.deduplicator.forget(update.update_id)
+        abort(503)
     return "!", 200
 
 
+@app.errorhandler(db.MaxConnectionsExceeded)
+def database_busy(error):
+    return 'Database is busy', 503, {'Retry-After': '1'}
+
+
+@app.route(settings.WEBHOOK_URL_PATH + 'stats')
+def stats_view():
+    return jsonify(stats.collect())
+
+
 @app.route("/")
 def index():
     return "!", 200
 
 
-def main():
-    logging.config.dictConfig(settings.LOGGER_CONF)
-
+def ensure_data_path():
     if not os.path.exists(settings.DATA_PATH):
-        try:
-            os.makedirs(settings.DATA_PATH, exist_ok=True)
-            logger.info('Path created: %s', settings.DATA_PATH)
-        except OSError as e:
-            logger.error('Failed to create path "%s", error: %s', settings.DATA_PATH, e)
-            return e.errno
-
-    if db:
-        existing_tables = db.get_tables()
-        models = [User, Post]
-        for model in models:
-            if model.__name__.lower() not in existing_tables:
-                logger.info('Creating new table: "%s"', model.__name__.lower())
-                model.create_table()
+        os.makedirs(settings.DATA_PATH, exist_ok=True)
+        logger.info('Path created: %s', settings.DATA_PATH)
+
+
+def set_webhook():
+    bot.remove_webhook()
+    bot.set_webhook(url='{}{}'.format(settings.WEBHOOK_URL_BASE, settings.WEBHOOK_URL_PATH))
+    logger.info('Webhook set to %s%s', settings.WEBHOOK_URL_BASE, settings.WEBHOOK_URL_PATH)
+
 
+def setup():
+    """One-time work of a deploy, kept out of worker boot"""
+    ensure_data_path()
+    db.create_tables()
+    set_webhook()
+
+
+boot_times = {'import': None, 'start': None}
+stats.register('boot', lambda: dict(boot_times))
+_start_lock = threading.Lock()
+
+
+def start():
+    """
+    Starts background tasks of a process serving updates. Called on the first
+    webhook request, nothing is connected to before that.
+    """
+    with _start_lock:
+        if boot_times['start'] is not None:
+            return
+        started = time.time()
+        logging.config.dictConfig(settings.LOGGER_CONF)
+        ensure_data_path()
+
+        node_prober.start()
+        users.activity_flusher.start()
+        atexit.register(users.flush_activity)
+        seen.flusher.start()
+        conversation.purger.start()
+        atexit.register(seen.flush)
+        if not sharding.is_worker():
+            # Started by every webhook process, gunicorn runs several. Tasks of which one
+            # should run at a time take a database lease, see db.exclusive(), analytics
+            # senders claim the events they send
+            dedup.pruner.start()
+            post_retention.start()
+            analytics.sender.start()
+        if router:
+            router.start()
+
+        boot_times['start'] = time.time() - started
+        logger.info('Bot imported in %.3fs and started in %.3fs', boot_times['import'], boot_times['start'])
+
+
+@app.before_first_request
+def start_on_first_request():
+    start()
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Steepshot Telegram bot')
+    parser.add_argument('command', choices=['setup', 'set-webhook', 'poll'],
+                        help='setup: create tables and set the webhook, once per deploy; '
+                             'poll: receive updates with long polling instead of the webhook')
+    args = parser.parse_args(argv)
+    logging.config.dictConfig(settings.LOGGER_CONF)
+
+    if args.command == 'setup':
+        setup()
+    elif args.command == 'set-webhook':
+        set_webhook()
+    elif args.command == 'poll':
+        ensure_data_path()
+        db.create_tables()
+        start()
+        logger.info('Start bot in polling mode. Listening...')
+        poller.run()
     return 0
 
 
-main()
+boot_times['import'] = time.time() - IMPORT_STARTED
 
 if __name__ == '__main__':
-    logger.info('Start bot in local mode. Listening...')
-    bot.polling(none_stop=True)
-else:
-    bot.remove_webhook()
-    bot.set_webhook(url='{}{}'.format(settings.WEBHOOK_URL_BASE, settings.WEBHOOK_URL_PATH))
+    sys.exit(main())
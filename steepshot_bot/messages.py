@@ -15,12 +15,21 @@ _messages = {
                      'if you want bot to forget your key.',
         'logged_in': 'You have been successfully logged into you Steem account!',
         'post_added': 'Your post has been successfully added!',
+        'post_queued': 'Your photo is queued for posting...',
+        'post_downloading': 'Downloading your photo...',
+        'post_preparing': 'Uploading your photo to Steepshot...',
+        'post_broadcasting': 'Publishing your post to Steem...',
         'post_not_added': 'Something went wrong. Please, try to add post later.',
         'fail_post_validate': 'There are some errors: {error}.',
         'title_required': 'Please enter the title of the post. You can write tags with #.',
         'upvoted': 'Post has been upvoted.',
         'commented': 'Your comment has been successfully added.',
         'no_photos': 'There is no photos to show in {source}.',
+        'no_new_photos': 'You have already seen the latest photos in {source}.',
+        'more_posts': 'Want to see more?',
+        'no_more_posts': 'There are no more photos.',
+        'only_seen_posts': 'You have already seen the next photos. Want to look further?',
+        'page_expired': 'This page has expired, please open the feed again.',
         'info': 'You can post photo by sending image to the bot (but don\'t forget to set checkbox _"Compressed"_.\n'
                 'You also can watch your feed and new/hot/top posts.',
         'already_authorized': 'You are already authorized.',
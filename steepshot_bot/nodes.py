@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from steep.steemd import Steemd
+
+from steepshot_bot import settings, stats
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest probe in the latency moving average
+LATENCY_SMOOTHING = 0.3
+
+
+def close_client(client):
+    """Closes the connections of a Steemd client or of a Steem object wrapping one."""
+    steemd = vars(client).get('steemd', client)
+    # vars(): steem clients turn unknown attributes into API calls
+    connections = vars(steemd)
+    try:
+        if connections.get('ws') is not None:
+            connections['ws'].close()
+        if connections.get('http') is not None:
+            connections['http'].clear()
+    except Exception as e:
+        logger.warning('Failed to close Steem client connections: %s', e)
+
+
+class NodeState(object):
+    def __init__(self, url: str):
+        self.url = url
+        self.latency = None
+        self.head_block = None
+        self.lag = None
+        self.healthy = True
+        self.failures = 0
+        self.last_error = None
+        self.last_probe = None
+        self.probing = False
+        self.client = None
+
+    def as_dict(self) -> dict:
+        return {
+            'latency': self.latency,
+            'head_block': self.head_block,
+            'lag': self.lag,
+            'healthy': self.healthy,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'last_probe': self.last_probe
+        }
+
+
+class NodeManager(object):
+    """
+    Probes Steem nodes for latency and head block and orders them healthiest first.
+    Nodes that fail or fall more than `max_lag` blocks behind are ejected until
+    a later probe finds them healthy again.
+    """
+
+    def __init__(self, urls: list, max_lag: int, timeout: float):
+        self.max_lag = max_lag
+        self.timeout = timeout
+        self.generation = 0
+        self._states = [NodeState(url) for url in urls]
+        self._ordered = list(urls)
+        self._lock = threading.Lock()
+        # steem clients retry failed calls internally, so probes are bounded by a timeout instead
+        self._executor = ThreadPoolExecutor(max_workers=len(urls) * 2)
+
+    def ordered(self) -> list:
+        """Healthy nodes by latency followed by ejected ones as a last resort."""
+        with self._lock:
+            return list(self._ordered)
+
+    def probe(self):
+        futures = {}
+        for state in self._states:
+            # A probe still hanging from the previous run keeps the node ejected
+            if not state.probing:
+                state.probing = True
+                futures[self._executor.submit(self._probe_node, state)] = state
+        # All nodes share one timeout, a round takes at most self.timeout seconds
+        _, not_done = wait(futures, timeout=self.timeout)
+        for future in not_done:
+            state = futures[future]
+            logger.error('Steem node %s did not answer in %s seconds.', state.url, self.timeout)
+            state.failures += 1
+            state.last_error = 'timeout'
+
+        heads = [state.head_block for state in self._states if state.head_block is not None]
+        best_head = max(heads) if heads else None
+        for state in self._states:
+            if state.last_error is None and state.head_block is not None:
+                state.lag = best_head - state.head_block
+                healthy = state.lag <= self.max_lag
+            else:
+                healthy = False
+            if healthy != state.healthy:
+                logger.warning('Steem node %s is %s.', state.url, 'back' if healthy else 'ejected')
+            state.healthy = healthy
+
+        ordered = [state.url for state in sorted(
+            self._states, key=lambda s: (not s.healthy, s.latency if s.latency is not None else float('inf'))
+        )]
+        with self._lock:
+            if ordered != self._ordered:
+                logger.info('Steem nodes order changed: %s', ordered)
+                self._ordered = ordered
+                self.generation += 1
+
+    def _probe_node(self, state: NodeState):
+        start = time.time()
+        state.last_probe = start
+        try:
+            if state.client is None:
+                state.client = Steemd(nodes=[state.url], num_retries=0)
+            head_block = state.client.get_dynamic_global_properties()['head_block_number']
+        except Exception as e:
+            logger.error('Failed to probe Steem node %s: %s', state.url, e)
+            if state.client is not None:
+                close_client(state.client)
+            state.client = None
+            state.failures += 1
+            state.last_error = str(e)
+            return
+        finally:
+            state.probing = False
+        latency = time.time() - start
+        if state.latency is None:
+            state.latency = latency
+        else:
+            state.latency = LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * state.latency
+        state.head_block = head_block
+        state.last_error = None
+
+    def as_dict(self) -> dict:
+        return {state.url: state.as_dict() for state in self._states}
+
+
+manager = NodeManager(list(settings.STEEM_NODES), settings.STEEM_NODE_MAX_LAG, settings.STEEM_NODE_PROBE_TIMEOUT)
+stats.register('steem_nodes', manager.as_dict)
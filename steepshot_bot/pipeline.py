@@ -0,0 +1,95 @@
+import logging
+import threading
+
+from steepshot_bot.stats import Timing
+from steepshot_bot.workers import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+
+class Stage(object):
+    """
+    One step of a pipeline with its own worker threads. Failed jobs are retried
+    `retries` times if the error is one of `retry_on`, waiting `backoff` seconds
+    doubled on every attempt.
+    """
+
+    def __init__(self, name: str, func, workers: int, retries: int = 0, backoff: float = 1,
+                 retry_on: tuple = (Exception,)):
+        self.name = name
+        self.func = func
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_on = retry_on
+        self.timing = Timing()
+        self.pool = WorkerPool('stage-' + name, workers)
+
+    def as_dict(self) -> dict:
+        result = self.timing.as_dict()
+        result['queued'] = self.pool.qsize()
+        return result
+
+
+class Pipeline(object):
+    """
+    Passes jobs through stages in order. on_stage(job, stage) is called before
+    a stage starts, on_error(job, stage, error) when a stage gives up and
+    on_done(job) after the last stage.
+    """
+
+    def __init__(self, stages: list, on_stage=None, on_error=None, on_done=None):
+        self.stages = stages
+        self.on_stage = on_stage
+        self.on_error = on_error
+        self.on_done = on_done
+
+    def submit(self, job):
+        self._schedule(0, job, 0)
+
+    def _schedule(self, index: int, job, attempt: int, delay: float = 0):
+        stage = self.stages[index]
+        if delay:
+            timer = threading.Timer(delay, stage.pool.submit, (self._run, index, job, attempt))
+            timer.daemon = True
+            timer.start()
+        else:
+            stage.pool.submit(self._run, index, job, attempt)
+
+    def _run(self, index: int, job, attempt: int):
+        stage = self.stages[index]
+        if attempt == 0 and self.on_stage:
+            self._notify(self.on_stage, job, stage)
+        try:
+            with stage.timing.time():
+                stage.func(job)
+        except stage.retry_on as e:
+            if attempt < stage.retries:
+                delay = stage.backoff * 2 ** attempt
+                logger.warning('Stage "%s" failed, retry %s in %ss: %s', stage.name, attempt + 1, delay, e)
+                self._schedule(index, job, attempt + 1, delay)
+                return
+            self._fail(job, stage, e)
+            return
+        except Exception as e:
+            self._fail(job, stage, e)
+            return
+
+        if index + 1 < len(self.stages):
+            self._schedule(index + 1, job, 0)
+        elif self.on_done:
+            self._notify(self.on_done, job)
+
+    def _fail(self, job, stage: Stage, error: Exception):
+        logger.error('Stage "%s" failed: %s', stage.name, error)
+        if self.on_error:
+            self._notify(self.on_error, job, stage, error)
+
+    @staticmethod
+    def _notify(callback, *args):
+        try:
+            callback(*args)
+        except Exception as e:
+            logger.exception('Pipeline callback failed: %s', e)
+
+    def as_dict(self) -> dict:
+        return {stage.name: stage.as_dict() for stage in self.stages}
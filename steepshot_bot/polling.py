@@ -0,0 +1,143 @@
+import logging
+import queue
+import threading
+import time
+
+import telebot
+
+from steepshot_bot.stats import Timing
+from steepshot_bot.workers import KeyedDispatcher
+
+logger = logging.getLogger(__name__)
+
+# Pause after a batch of which no update could be taken, the update queue being full
+BUSY_DELAY = 0.5
+ERROR_DELAY = 3
+
+
+class Poller(object):
+    """
+    Receives updates with long getUpdates requests and runs handler(update) on the
+    dispatcher keyed by key_func(update), so updates of one chat stay in order.
+
+    An update is confirmed to Telegram, by requesting the next batch with a higher
+    offset, once it and all updates before it are handled. Updates still being
+    handled come again in the following batches and are skipped. When a batch brings
+    nothing new, the updates in progress are confirmed before they are handled, so
+    the next request waits for new updates rather than returning them again, and a
+    slow chat does not hold back the others. Those are lost if the process stops
+    before handling them.
+    """
+
+    def __init__(self, bot: telebot.TeleBot, dispatcher: KeyedDispatcher, handler, key_func,
+                 timeout: int, limit: int):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.handler = handler
+        self.key_func = key_func
+        self.timeout = timeout
+        self.limit = limit
+        self.requests = Timing()
+        self.received = 0
+        self.confirmed_early = 0
+        self._offset = None
+        self._pending = set()
+        self._done = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Polls in a daemon thread"""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self.run, name='poller', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        self.bot.remove_webhook()
+        logger.info('Polling for updates, timeout %ss, batches of %s', self.timeout, self.limit)
+        while not self._stopped.is_set():
+            try:
+                with self.requests.time():
+                    updates = self.bot.get_updates(offset=self._offset, limit=self.limit, timeout=self.timeout)
+            except Exception as e:
+                logger.error('Failed to get updates: %s', e)
+                self._stopped.wait(ERROR_DELAY)
+                continue
+            if updates and not self._submit(updates) and not self._skip_taken(updates):
+                self._stopped.wait(BUSY_DELAY)
+
+    def _submit(self, updates: list) -> int:
+        """Returns the number of new updates taken"""
+        taken = 0
+        for update in updates:
+            with self._lock:
+                # The batch may have been requested before earlier updates were confirmed
+                if self._offset is not None and update.update_id < self._offset:
+                    continue
+                if update.update_id in self._pending or update.update_id in self._done:
+                    continue
+                self._pending.add(update.update_id)
+            try:
+                self.dispatcher.submit(self.key_func(update), self._handle, update)
+            except queue.Full:
+                with self._lock:
+                    self._pending.discard(update.update_id)
+                logger.warning('Update queue is full, update %s will be received again', update.update_id)
+                break
+            taken += 1
+        self.received += taken
+        return taken
+
+    def _skip_taken(self, updates: list) -> bool:
+        """Moves the offset past the leading updates of the batch already taken, returns whether it moved"""
+        with self._lock:
+            offset = self._offset
+            for update in updates:
+                if offset is not None and update.update_id < offset:
+                    continue
+                if update.update_id not in self._pending and update.update_id not in self._done:
+                    break
+                offset = update.update_id + 1
+            if offset == self._offset:
+                return False
+            self.confirmed_early += len([i for i in self._pending if i < offset and
+                                         (self._offset is None or i >= self._offset)])
+            self._offset = offset
+            self._done = {i for i in self._done if i >= offset}
+            return True
+
+    def _handle(self, update: telebot.types.Update):
+        try:
+            self.handler(update)
+        finally:
+            self._complete(update.update_id)
+
+    def _complete(self, update_id: int):
+        with self._lock:
+            self._pending.discard(update_id)
+            self._done.add(update_id)
+            # Everything below the oldest unfinished update can be confirmed. The offset
+            # never goes back, updates confirmed early by _skip_taken() may still be pending
+            if self._pending:
+                offset = min(self._pending)
+            else:
+                offset = max(self._done) + 1
+            if self._offset is None or offset > self._offset:
+                self._offset = offset
+            self._done = {i for i in self._done if i >= self._offset}
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'offset': self._offset,
+            'received': self.received,
+            'pending': pending,
+            'confirmed_early': self.confirmed_early,
+            'requests': self.requests.as_dict()
+        }
@@ -0,0 +1,123 @@
+import logging
+import time
+
+import telebot
+from requests import RequestException
+from telebot.apihelper import ApiException
+
+from steepshot_bot import settings, stats, steem, logic, uploads, analytics, db
+from steepshot_bot.exceptions import SteepshotBotError, SteemError, SteepshotConnectionError
+from steepshot_bot.messages import get_message
+from steepshot_bot.pipeline import Pipeline, Stage
+
+logger = logging.getLogger(__name__)
+
+STAGE_MESSAGES = {
+    'download': 'post_downloading',
+    'prepare': 'post_preparing',
+    'broadcast': 'post_broadcasting'
+}
+
+
+class PostJob(object):
+    def __init__(self, chat_id: int, username: str, lang: str, file_id: str, title: str):
+        self.chat_id = chat_id
+        self.username = username
+        self.lang = lang
+        self.file_id = file_id
+        self.title = title
+        self.status_message_id = None
+        self.image = None  # uploads.PhotoFile
+        self.digest = None
+        self.data = None
+        self.steem_error = None
+
+
+def create_pipeline(bot: telebot.TeleBot) -> Pipeline:
+    def update_status(job: PostJob, text: str):
+        bot.edit_message_text(text, job.chat_id, job.status_message_id, parse_mode='markdown')
+
+    def download(job: PostJob):
+        index = uploads.upload_index
+        job.digest = index.get_digest(job.username, job.file_id)
+        if job.digest:
+            job.data = index.get_prepared(job.username, job.digest, job.title)
+            if job.data:
+                return
+        job.image = uploads.download_photo(bot, job.file_id)
+        job.digest = job.image.digest
+        index.set_digest(job.username, job.file_id, job.digest)
+        job.data = index.get_prepared(job.username, job.digest, job.title)
+        if job.data:
+            release_image(job)
+
+    def normalise(job: PostJob):
+        if job.data:
+            return
+        try:
+            job.image = uploads.normalise_photo(job.image)
+        except Exception as e:
+            logger.error('Failed to normalise photo, uploading it unchanged: %s', e)
+
+    def prepare(job: PostJob):
+        if job.data:
+            logger.info('Reusing prepared upload of the same photo for user "%s"', job.username)
+            return
+        start = time.time()
+        try:
+            job.data = logic.prepare_post(job.image.reader(), job.title, job.username)
+        except Exception:
+            uploads.upload_stats.add_upload(job.image.size, time.time() - start, error=True)
+            raise
+        uploads.upload_stats.add_upload(job.image.size, time.time() - start)
+        uploads.upload_index.set_prepared(job.username, job.digest, job.title, job.data)
+        release_image(job)
+
+    def broadcast(job: PostJob):
+        try:
+            steem.add_post_to_steem(job.data)
+            uploads.upload_index.discard(job.username, job.digest, job.title)
+        except SteemError as e:
+            job.steem_error = e
+
+    def log(job: PostJob):
+        with db.connection():
+            analytics.log_new_post(job.username, str(job.steem_error) if job.steem_error else None)
+
+    def on_stage(job: PostJob, stage: Stage):
+        if stage.name in STAGE_MESSAGES:
+            update_status(job, get_message(STAGE_MESSAGES[stage.name], locale=job.lang))
+        elif stage.name == 'log':
+            if job.steem_error:
+                update_status(job, job.steem_error.get_msg(job.lang))
+            else:
+                update_status(job, get_message('post_added', locale=job.lang))
+
+    def release_image(job: PostJob):
+        if job.image:
+            job.image.close()
+            job.image = None
+
+    def on_error(job: PostJob, stage: Stage, error: Exception):
+        release_image(job)
+        if stage.name == 'log':
+            return
+        if isinstance(error, SteepshotBotError):
+            update_status(job, error.get_msg(job.lang))
+        else:
+            update_status(job, get_message('post_not_added', locale=job.lang))
+
+    conf = settings.POST_PIPELINE_STAGES
+    pipeline = Pipeline(
+        [
+            Stage('download', download, retry_on=(RequestException, ApiException), **conf['download']),
+            Stage('normalise', normalise, **conf['normalise']),
+            Stage('prepare', prepare, retry_on=(SteepshotConnectionError,), **conf['prepare']),
+            Stage('broadcast', broadcast, **conf['broadcast']),
+            Stage('log', log, **conf['log'])
+        ],
+        on_stage=on_stage,
+        on_error=on_error
+    )
+    stats.register('post_pipeline', pipeline.as_dict)
+    return pipeline
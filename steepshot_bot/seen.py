@@ -0,0 +1,251 @@
+"""
+Posts already shown to a user, so feed pages can skip them.
+
+Every user has a rolling pair of Bloom filters of SEEN_POSTS_CAPACITY posts each:
+when the current filter is full it replaces the previous one and a new one is
+started, so memory per user is fixed and the oldest posts are forgotten.
+A post may be reported as seen while it was not with SEEN_POSTS_ERROR_RATE
+probability, each filter is sized for half of it as both are checked. A post is
+never reported unseen after being shown.
+
+Processes keep their own copy of a user's filters. flush() merges the saved ones
+into it before writing, so posts marked by other processes are kept.
+"""
+import datetime
+import hashlib
+import logging
+import math
+import struct
+import threading
+
+from peewee import IntegrityError
+
+from steepshot_bot import settings, stats
+from steepshot_bot.cache import LRUCache
+from steepshot_bot.db import SeenPosts, connection, get_db
+from steepshot_bot.workers import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('>IBI')
+_GENERATION = struct.Struct('>I')
+
+
+class BloomFilter(object):
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.count = 0
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        # Double hashing: k positions from two 64 bit halves of one digest
+        digest = hashlib.sha256(item.encode()).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def update(self, other: 'BloomFilter'):
+        """Adds the items of other, made with the same settings"""
+        bits = int.from_bytes(self.bits, 'big') | int.from_bytes(other.bits, 'big')
+        self.bits = bytearray(bits.to_bytes(len(self.bits), 'big'))
+        # Items of both are not known, estimated from the bits set
+        set_bits = bin(bits).count('1')
+        if set_bits >= self.size:
+            estimate = self.capacity
+        else:
+            estimate = int(round(-self.size / self.hashes * math.log(1 - set_bits / self.size)))
+        self.count = max(self.count, other.count, estimate)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def is_full(self) -> bool:
+        return self.count >= self.capacity
+
+    def to_bytes(self) -> bytes:
+        return _HEADER.pack(self.size, self.hashes, self.count) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, capacity: int, error_rate: float, data: bytes):
+        """Returns the filter and the rest of data, or None if it was made with other settings"""
+        bloom = cls(capacity, error_rate)
+        if len(data) < _HEADER.size:
+            return None, b''
+        size, hashes, count = _HEADER.unpack_from(data)
+        end = _HEADER.size + len(bloom.bits)
+        if (size, hashes) != (bloom.size, bloom.hashes) or len(data) < end:
+            return None, b''
+        bloom.bits = bytearray(data[_HEADER.size:end])
+        bloom.count = count
+        return bloom, data[end:]
+
+
+class SeenFilter(object):
+    """
+    Current and previous Bloom filter of one user. generation counts the rotations,
+    so filters of two processes can be matched up by merge().
+    """
+
+    def __init__(self, capacity: int, error_rate: float, current: BloomFilter = None,
+                 previous: BloomFilter = None, generation: int = 0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.current = current or BloomFilter(capacity, error_rate / 2)
+        self.previous = previous
+        self.generation = generation
+
+    def add(self, identifier: str):
+        # Posts only in the previous filter are added again, so they outlive its rotation
+        if identifier in self.current:
+            return
+        if self.current.is_full():
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.error_rate / 2)
+            self.generation += 1
+        self.current.add(identifier)
+
+    def _update_previous(self, bloom: BloomFilter):
+        if self.previous is None:
+            self.previous = bloom
+        else:
+            self.previous.update(bloom)
+
+    def merge(self, other: 'SeenFilter'):
+        """Adds the posts of other, a copy of the same user's filters that went its own way"""
+        if other.generation > self.generation + 1:
+            # Everything kept here is older than both filters of other
+            self.current, self.previous, self.generation = other.current, other.previous, other.generation
+        elif other.generation == self.generation + 1:
+            current = self.current
+            if other.previous is not None:
+                current.update(other.previous)
+            self.current, self.previous, self.generation = other.current, current, other.generation
+        elif other.generation == self.generation:
+            self.current.update(other.current)
+            if other.previous is not None:
+                self._update_previous(other.previous)
+        elif other.generation == self.generation - 1:
+            self._update_previous(other.current)
+
+    def __contains__(self, identifier: str) -> bool:
+        return identifier in self.current or (self.previous is not None and identifier in self.previous)
+
+    def to_bytes(self) -> bytes:
+        return _GENERATION.pack(self.generation) + self.current.to_bytes() + \
+            (self.previous.to_bytes() if self.previous else b'')
+
+    @classmethod
+    def from_bytes(cls, capacity: int, error_rate: float, data: bytes):
+        """Returns an empty filter if data was saved with other settings"""
+        if len(data) < _GENERATION.size:
+            return cls(capacity, error_rate)
+        generation, = _GENERATION.unpack_from(data)
+        current, rest = BloomFilter.from_bytes(capacity, error_rate / 2, data[_GENERATION.size:])
+        if current is None:
+            return cls(capacity, error_rate)
+        previous = None
+        if rest:
+            previous, _ = BloomFilter.from_bytes(capacity, error_rate / 2, rest)
+        return cls(capacity, error_rate, current, previous, generation)
+
+
+# Times flush() reads and writes the filters of a user changed meanwhile by other processes
+FLUSH_ATTEMPTS = 3
+
+_cache = LRUCache(settings.SEEN_POSTS_CACHE_SIZE)
+_dirty = {}
+_lock = threading.Lock()
+
+
+def get_filter(user_id: int) -> SeenFilter:
+    seen = _cache.get(user_id)
+    if seen is None:
+        try:
+            row = SeenPosts.get(SeenPosts.user_id == user_id)
+            seen = SeenFilter.from_bytes(settings.SEEN_POSTS_CAPACITY, settings.SEEN_POSTS_ERROR_RATE, bytes(row.data))
+        except SeenPosts.DoesNotExist:
+            seen = SeenFilter(settings.SEEN_POSTS_CAPACITY, settings.SEEN_POSTS_ERROR_RATE)
+        _cache.set(user_id, seen)
+    return seen
+
+
+def add(user_id: int, identifiers: list):
+    """Marks posts as seen, they are written to the database by flush()"""
+    seen = get_filter(user_id)
+    with _lock:
+        for identifier in identifiers:
+            seen.add(identifier)
+        _dirty[user_id] = seen
+
+
+def _save(user_id: int, seen: SeenFilter) -> bool:
+    """
+    Merges the saved filters of the user into `seen` and writes the result, unless
+    another process wrote them since they were read. Returns whether it was written.
+    """
+    try:
+        stored = bytes(SeenPosts.get(SeenPosts.user_id == user_id).data)
+    except SeenPosts.DoesNotExist:
+        stored = None
+    with _lock:
+        # Serialized under the lock, add() may change the filters meanwhile
+        if stored is not None:
+            seen.merge(SeenFilter.from_bytes(seen.capacity, seen.error_rate, stored))
+        data = seen.to_bytes()
+    fields = {'data': data, 'updated_at': datetime.datetime.now()}
+    if stored is None:
+        try:
+            with get_db().atomic():
+                SeenPosts.create(user_id=user_id, **fields)
+        except IntegrityError:
+            return False
+        return True
+    return bool(SeenPosts.update(**fields).where(SeenPosts.user_id == user_id, SeenPosts.data == stored).execute())
+
+
+def flush():
+    global _dirty
+
+    with _lock:
+        pending, _dirty = _dirty, {}
+    if not pending:
+        return
+    failed = []
+    try:
+        with connection():
+            for user_id, seen in pending.items():
+                try:
+                    for _ in range(FLUSH_ATTEMPTS):
+                        if _save(user_id, seen):
+                            break
+                    else:
+                        raise RuntimeError('written by other processes meanwhile')
+                except Exception as e:
+                    logger.error('Failed to save seen posts of user %s: %s', user_id, e)
+                    failed.append(user_id)
+    except Exception as e:
+        logger.error('Failed to save seen posts of %s users: %s', len(pending), e)
+        failed = list(pending)
+    with _lock:
+        for user_id in failed:
+            _dirty.setdefault(user_id, pending[user_id])
+
+
+def as_dict() -> dict:
+    return {
+        'cached': len(_cache),
+        'pending': len(_dirty),
+        'bytes_per_user': _GENERATION.size + 2 * len(
+            BloomFilter(settings.SEEN_POSTS_CAPACITY, settings.SEEN_POSTS_ERROR_RATE / 2).to_bytes())
+    }
+
+
+flusher = PeriodicTask('seen-posts', settings.SEEN_POSTS_FLUSH_INTERVAL, flush)
+stats.register('seen_posts', as_dict)
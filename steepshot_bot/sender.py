@@ -0,0 +1,201 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import telebot
+from telebot.apihelper import ApiException
+
+from steepshot_bot import settings, stats
+from steepshot_bot.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Lower is sent first when the global limit is reached
+PRIORITY_ANSWER = 0
+PRIORITY_REPLY = 1
+PRIORITY_BULK = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_ANSWER: 'answer',
+    PRIORITY_REPLY: 'reply',
+    PRIORITY_BULK: 'bulk'
+}
+
+
+class TokenBucket(object):
+    """Allows `rate` calls per second with bursts of up to `capacity` calls. Not thread-safe."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available"""
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        self.tokens -= 1
+
+    def reserve(self, now: float) -> float:
+        """Takes a token in advance, returns seconds to wait before using it"""
+        self._refill(now)
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+
+class SendScheduler(object):
+    """
+    Paces outgoing Telegram requests. A request first waits for its chat bucket,
+    private chats and groups have their own limits, and then for the global bucket,
+    where waiting requests are served by priority and then in arrival order.
+    Chats can be paused after Telegram answers 429 Too Many Requests.
+    """
+
+    def __init__(self, rate: float, burst: int, chat_rate: float, chat_burst: int,
+                 group_rate: float, group_burst: int, max_chats: int = 10000):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.throttled = 0
+        self.wait = stats.Timings()
+        self._global = TokenBucket(rate, burst)
+        self._chats = LRUCache(max_chats)
+        self._paused = LRUCache(max_chats)
+        self._waiting = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Group and channel ids are negative
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats.set(chat_id, bucket)
+        return bucket
+
+    def acquire(self, chat_id, priority: int):
+        start = time.monotonic()
+        if chat_id is not None:
+            with self._lock:
+                now = time.monotonic()
+                delay = max(self._chat_bucket(chat_id).reserve(now), self._paused.get(chat_id, 0) - now)
+            if delay > 0:
+                time.sleep(delay)
+
+        ticket = (priority, next(self._counter))
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                timeout = None
+                if self._waiting[0] == ticket:
+                    timeout = self._global.delay(time.monotonic())
+                    if timeout <= 0:
+                        break
+                self._condition.wait(timeout)
+            self._global.take()
+            heapq.heappop(self._waiting)
+            self._condition.notify_all()
+        self.wait[PRIORITY_NAMES.get(priority, str(priority))].add(time.monotonic() - start)
+
+    def reserve(self, chat_id) -> float:
+        """
+        Non-blocking acquire for async callers: takes the tokens in advance and returns
+        the seconds to wait before sending. Reserved requests are not ordered by priority.
+        """
+        with self._lock:
+            now = time.monotonic()
+            delay = self._global.reserve(now)
+            if chat_id is not None:
+                delay = max(delay, self._chat_bucket(chat_id).reserve(now), self._paused.get(chat_id, 0) - now)
+        return delay
+
+    def pause(self, chat_id, seconds: float):
+        self.throttled += 1
+        if chat_id is None:
+            # Requests without a chat, i.e. callback answers, share the global limit
+            with self._lock:
+                self._global.tokens = min(self._global.tokens, -seconds * self._global.rate)
+            return
+        self._paused.set(chat_id, time.monotonic() + seconds)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            waiting = len(self._waiting)
+        return {
+            'waiting': waiting,
+            'throttled': self.throttled,
+            'wait': self.wait.as_dict()
+        }
+
+
+def get_retry_after(error: ApiException):
+    """Seconds Telegram asked to wait if the error is 429 Too Many Requests, None otherwise"""
+    response = getattr(error, 'result', None)
+    if response is None or getattr(response, 'status_code', None) != 429:
+        return None
+    try:
+        return response.json()['parameters']['retry_after']
+    except (ValueError, KeyError, TypeError):
+        return 1
+
+
+scheduler = SendScheduler(
+    settings.SEND_RATE, settings.SEND_BURST,
+    settings.SEND_CHAT_RATE, settings.SEND_CHAT_BURST,
+    settings.SEND_GROUP_RATE, settings.SEND_GROUP_BURST
+)
+stats.register('sends', scheduler.as_dict)
+
+
+class ThrottledTeleBot(telebot.TeleBot):
+    """TeleBot whose sending methods go through the send scheduler and are retried on 429."""
+
+    def __init__(self, *args, scheduler: SendScheduler = scheduler, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+
+    def _send(self, chat_id, priority: int, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.scheduler.acquire(chat_id, priority)
+            try:
+                return func(*args, **kwargs)
+            except ApiException as e:
+                retry_after = get_retry_after(e)
+                if retry_after is None or attempt >= settings.SEND_RETRIES:
+                    raise
+                attempt += 1
+                logger.warning('Too many requests to chat %s, retry in %ss', chat_id, retry_after)
+                self.scheduler.pause(chat_id, retry_after)
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self._send(chat_id, PRIORITY_REPLY, super().send_message, chat_id, *args, **kwargs)
+
+    def send_photo(self, chat_id, *args, **kwargs):
+        return self._send(chat_id, PRIORITY_BULK, super().send_photo, chat_id, *args, **kwargs)
+
+    def send_media_group(self, chat_id, *args, **kwargs):
+        return self._send(chat_id, PRIORITY_BULK, super().send_media_group, chat_id, *args, **kwargs)
+
+    def edit_message_text(self, text, chat_id=None, *args, **kwargs):
+        return self._send(chat_id, PRIORITY_REPLY, super().edit_message_text, text, chat_id, *args, **kwargs)
+
+    def delete_message(self, chat_id, *args, **kwargs):
+        return self._send(chat_id, PRIORITY_REPLY, super().delete_message, chat_id, *args, **kwargs)
+
+    def answer_callback_query(self, *args, **kwargs):
+        return self._send(None, PRIORITY_ANSWER, super().answer_callback_query, *args, **kwargs)
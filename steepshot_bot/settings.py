@@ -4,6 +4,9 @@ PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 
+# Key for signing post identifiers in inline button callback data
+CALLBACK_SECRET = os.getenv('CALLBACK_SECRET', TELEGRAM_BOT_TOKEN or '')
+
 DEBUG = os.getenv('DEBUG') == 'True'
 
 USE_WEBSOCKET_NODES = True
@@ -13,10 +16,112 @@ STEEM_NODES = (
     ('wss://steemd.steemitstage.com', 'wss://steemd2.steepshot.org', 'wss://steemd-int.steemit.com')
 )[USE_WEBSOCKET_NODES]
 
+# Nodes are probed in background and used fastest first. Nodes more than
+# STEEM_NODE_MAX_LAG blocks behind the best one are not used until they catch up
+STEEM_NODE_PROBE_INTERVAL = 30
+STEEM_NODE_PROBE_TIMEOUT = 10
+STEEM_NODE_MAX_LAG = 20
+
+# Steem clients per pool, one pool signs transactions and one broadcasts them
+STEEM_POOL_SIZE = 8
+
 STEEPSHOT_API = 'https://steepshot.org/api'
 if DEBUG:
     STEEPSHOT_API = 'https://qa.steepshot.org/api'
 
+# Keep-alive connections kept open to the Steepshot API
+STEEPSHOT_API_POOL_SIZE = 16
+# (connect, read) timeouts in seconds per API endpoint
+STEEPSHOT_API_TIMEOUTS = {
+    'default': (3.05, 10),
+    'post_prepare': (3.05, 60)
+}
+
+# Feed responses are fresh for FEED_CACHE_TTL seconds and then served stale while
+# being refreshed in background for up to FEED_CACHE_STALE_TTL more seconds
+FEED_CACHE_TTL = 60
+FEED_CACHE_STALE_TTL = 600
+FEED_CACHE_SIZE = 1000
+# Posts per feed page. The next page is fetched while the user looks at the current
+# one, "More" buttons work for FEED_CURSOR_TTL seconds. Their cursors are stored in
+# the database, FEED_CURSOR_SIZE of them are also kept in memory
+FEED_PAGE_SIZE = 5
+FEED_CURSOR_SIZE = 10000
+FEED_CURSOR_TTL = 60 * 60
+# Posts a user was already shown are skipped in feeds, reading up to this many pages
+# to fill one. Each user remembers up to twice SEEN_POSTS_CAPACITY posts in a fixed
+# amount of memory, a post is wrongly taken as seen with up to SEEN_POSTS_ERROR_RATE
+# probability. Changing either forgets the saved posts
+FEED_SEEN_MAX_PAGES = 4
+SEEN_POSTS_CAPACITY = 1000
+SEEN_POSTS_ERROR_RATE = 0.01
+SEEN_POSTS_CACHE_SIZE = 5000
+SEEN_POSTS_FLUSH_INTERVAL = 30
+
+# Telegram file_ids of already sent feed images, kept in memory and in the database
+FILE_ID_CACHE_SIZE = 10000
+FILE_ID_CACHE_DB_SIZE = 100000
+
+# How a feed page is sent: 'serial' photo by photo or 'album' as one media group
+# followed by a message with buttons. Both keep the photos in page order
+FEED_DELIVERY_MODE = 'serial'
+
+# Sent posts are kept for resolving button callbacks for this many days
+POST_RETENTION_DAYS = 30
+POST_RETENTION_INTERVAL = 60 * 60
+POST_RETENTION_BATCH_SIZE = 1000
+
+# Downloaded photos are kept in memory up to UPLOAD_SPOOL_SIZE bytes and
+# written to a temporary file above that. Larger photos than UPLOAD_MAX_SIZE are refused
+UPLOAD_SPOOL_SIZE = 512 * 1024
+UPLOAD_MAX_SIZE = 20 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Prepared uploads are reused when a user sends the same photo with the same title
+# again within UPLOAD_DEDUP_TTL seconds, e.g. after a failed post
+UPLOAD_DEDUP_SIZE = 1000
+UPLOAD_DEDUP_TTL = 30 * 60
+
+# Photos are uploaded at most IMAGE_TARGET_SIZE pixels on the longer side: the smallest
+# Telegram size covering it is downloaded and larger photos are downscaled and
+# recompressed if Pillow is installed. None uploads the largest size unchanged
+IMAGE_TARGET_SIZE = None
+IMAGE_JPEG_QUALITY = 85
+
+# Photo posting stages: worker threads, retries and delay before the first retry in seconds
+POST_PIPELINE_STAGES = {
+    'download': {'workers': 4, 'retries': 3, 'backoff': 1},
+    'normalise': {'workers': 2, 'retries': 0, 'backoff': 0},
+    'prepare': {'workers': 4, 'retries': 2, 'backoff': 2},
+    # Broadcasting again could publish the post twice
+    'broadcast': {'workers': 2, 'retries': 0, 'backoff': 0},
+    'log': {'workers': 1, 'retries': 2, 'backoff': 1}
+}
+
+# Post and upvote analytics are queued in the database and sent in background
+ANALYTICS_SEND_INTERVAL = 2
+ANALYTICS_BATCH_SIZE = 100
+ANALYTICS_MAX_ATTEMPTS = 10
+ANALYTICS_RETRY_BACKOFF = 5
+# Seconds a batch taken by one process is skipped by the others, longer than sending it takes
+ANALYTICS_CLAIM_TIMEOUT = 300
+
+# Where users' unfinished dialogs (login, comment, post title) are kept: 'db' lets any
+# worker process continue them and keeps them over restarts, 'memory' is per process
+CONVERSATION_STORE = 'db'
+# Unfinished dialogs are forgotten after this many seconds and removed every
+# CONVERSATION_PURGE_INTERVAL seconds
+CONVERSATION_TTL = 24 * 60 * 60
+CONVERSATION_PURGE_INTERVAL = 60 * 60
+# The 'db' store caches lookups for this many seconds in processes that alone handle
+# their users: polling, aio and UPDATE_PROCESSES workers. Webhook processes do not cache
+CONVERSATION_CACHE_SIZE = 10000
+CONVERSATION_CACHE_TTL = 30
+
+# Users are cached in memory, their last action time is saved every few seconds
+USER_CACHE_SIZE = 10000
+USER_ACTIVITY_FLUSH_INTERVAL = 5
+
 WEBHOOK_HOST = '<enter-you-domain-name>'  # IP/host where the bot is running
 
 WEBHOOK_URL_BASE = 'https://%s:%s' % (WEBHOOK_HOST, 443)
@@ -24,9 +129,70 @@ WEBHOOK_URL_PATH = '/%s/' % TELEGRAM_BOT_TOKEN
 
 DATA_PATH = os.path.join(os.path.dirname(PROJECT_PATH), 'data')
 SQLITE_DATABASE_URL = 'sqlite:///' + os.path.join(DATA_PATH, 'users.db')
+# Connections are taken from a pool for every update and returned after it. A thread
+# waits up to DATABASE_POOL_TIMEOUT seconds while all are in use, the pool size is set
+# below the worker settings. Idle ones older than DATABASE_STALE_TIMEOUT seconds are reopened
+DATABASE_POOL = True
+DATABASE_POOL_TIMEOUT = 10
+# Times an update or an aio blocking call waits for the pool before it fails
+DATABASE_CHECKOUT_ATTEMPTS = 3
+DATABASE_STALE_TIMEOUT = 300
 
 POST_BASE_URL = 'https://alpha.steepshot.io/post'
 
+# How updates are received: 'webhook' behind nginx, 'polling' with long getUpdates
+# requests run by `python -m steepshot_bot.main poll`, which needs no public HTTPS
+# endpoint, or 'aio' for the asyncio webhook server started by `python -m steepshot_bot.aio`.
+# Webhooks are registered by `python -m steepshot_bot.main setup`, not on startup
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'webhook')
+# Seconds a getUpdates request waits for updates and updates per request
+POLLING_TIMEOUT = 50
+POLLING_LIMIT = 100
+# Address of the asyncio server, updates it handles at once and threads running
+# blocking handlers (Steem signing, database) for it
+AIO_HOST = '127.0.0.1'
+AIO_PORT = 8001
+AIO_MAX_UPDATES = 500
+AIO_BLOCKING_WORKERS = 32
+
+# Incoming updates are acknowledged at once and handled by this many threads
+UPDATE_WORKERS = 8
+# Updates waiting or in progress before the webhook starts answering 503
+UPDATE_QUEUE_SIZE = 1000
+# Threads of one process that may hold a database connection at once besides the
+# update handlers: feed refreshers, the posting log stage, periodic tasks and stats requests
+DATABASE_BACKGROUND_CONNECTIONS = 10
+# Pooled connections per process: one for every thread that may need one, so a thread
+# only waits for the pool on bursts. Updates are handled by the AIO_BLOCKING_WORKERS
+# threads in 'aio' mode and by the UPDATE_WORKERS threads otherwise
+DATABASE_MAX_CONNECTIONS = (AIO_BLOCKING_WORKERS if UPDATE_MODE == 'aio' else UPDATE_WORKERS) \
+    + DATABASE_BACKGROUND_CONNECTIONS
+# With UPDATE_PROCESSES > 0 the webhook process only routes updates: each user is
+# always handled by the same one of this many worker processes, so logged in keys
+# and caches are not duplicated. Run a single gunicorn worker in front of them
+UPDATE_PROCESSES = 0
+# Updates waiting for a worker process before the webhook starts answering 503
+UPDATE_PROCESS_QUEUE_SIZE = 1000
+
+# update_ids handled in the last UPDATE_DEDUP_TTL seconds are remembered and redelivered
+# updates dropped. They are recorded in the database, shared by all webhook processes and
+# kept over restarts, and the last UPDATE_DEDUP_SIZE of them also in memory. Older ones
+# are deleted every UPDATE_DEDUP_PRUNE_INTERVAL seconds
+UPDATE_DEDUP_SIZE = 50000
+UPDATE_DEDUP_TTL = 24 * 60 * 60
+UPDATE_DEDUP_PRUNE_INTERVAL = 600
+
+# Outgoing Telegram requests per second with bursts, overall, per private chat and
+# per group. Requests over a limit wait, callback answers go before replies and feed photos
+SEND_RATE = 30
+SEND_BURST = 30
+SEND_CHAT_RATE = 1
+SEND_CHAT_BURST = 3
+SEND_GROUP_RATE = 20 / 60
+SEND_GROUP_BURST = 3
+# Retries of a request answered 429 Too Many Requests, after the time Telegram asks for
+SEND_RETRIES = 2
+
 LOGGER_CONF = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -0,0 +1,116 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import zlib
+
+from steepshot_bot.stats import Timing
+
+logger = logging.getLogger(__name__)
+
+WORKER_ENV = 'STEEPSHOT_BOT_WORKER'
+
+
+def is_worker() -> bool:
+    """True inside a process started by ShardRouter"""
+    return WORKER_ENV in os.environ
+
+
+def shard_of(key: int, shards: int) -> int:
+    # hash() of str is randomized per process, crc32 is stable across restarts
+    return zlib.crc32(str(key).encode()) % shards
+
+
+def _worker_main(index: int, updates: multiprocessing.Queue):
+    os.environ[WORKER_ENV] = str(index)
+    # Imported here: the module sets up the bot and its handlers for this process
+    from steepshot_bot import main
+
+    main.start()
+    logger.info('Update worker %s started, pid %s', index, os.getpid())
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        try:
+            main.handle_update_json(data)
+        except Exception as e:
+            logger.exception('Failed to handle update in worker %s: %s', index, e)
+
+
+class ShardRouter(object):
+    """
+    Sends updates to a fixed number of worker processes, each user always to the
+    same one. Logged in Steem accounts, their keys and the user cache live in one
+    process per user instead of being loaded by every process that sees the user.
+    """
+
+    def __init__(self, processes: int, queue_size: int):
+        self.processes = processes
+        self.queue_size = queue_size
+        self.put = Timing()
+        self.restarts = 0
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = [None] * processes
+        self._queues = [None] * processes
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            for index in range(self.processes):
+                if self._workers[index] is None:
+                    self._start_worker(index)
+
+    def stop(self):
+        with self._lock:
+            for index, process in enumerate(self._workers):
+                if process is not None:
+                    self._queues[index].put(None)
+            for process in self._workers:
+                if process is not None:
+                    process.join(5)
+
+    def _start_worker(self, index: int):
+        self._queues[index] = self._context.Queue(self.queue_size)
+        process = self._context.Process(target=_worker_main, args=(index, self._queues[index]),
+                                        name='update-worker-%s' % index, daemon=True)
+        process.start()
+        self._workers[index] = process
+
+    def _ensure_alive(self, index: int):
+        with self._lock:
+            process = self._workers[index]
+            if process is not None and process.is_alive():
+                return
+            if process is not None:
+                logger.error('Update worker %s exited with code %s, restarting', index, process.exitcode)
+                self.restarts += 1
+            # Updates queued for a dead worker are lost, Telegram does not redeliver them
+            self._start_worker(index)
+
+    def submit(self, key: int, data: dict):
+        """Raises queue.Full if the worker of this key is too far behind."""
+        index = shard_of(key, self.processes)
+        self._ensure_alive(index)
+        with self.put.time():
+            self._queues[index].put_nowait(data)
+
+    def as_dict(self) -> dict:
+        workers = []
+        for process, updates in zip(self._workers, self._queues):
+            try:
+                depth = updates.qsize() if updates else 0
+            except NotImplementedError:
+                # Not available on macOS
+                depth = None
+            workers.append({
+                'pid': process.pid if process else None,
+                'alive': bool(process and process.is_alive()),
+                'depth': depth
+            })
+        return {
+            'workers': workers,
+            'restarts': self.restarts,
+            'put': self.put.as_dict()
+        }
@@ -0,0 +1,71 @@
+import threading
+import time
+from contextlib import contextmanager
+
+_providers = {}
+
+
+def register(name: str, provider):
+    """Register a callable returning a dict of values shown on the stats page."""
+    _providers[name] = provider
+
+
+def collect() -> dict:
+    return {name: provider() for name, provider in sorted(_providers.items())}
+
+
+class Timing(object):
+    """Thread-safe count/error/latency accumulator."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float, error: bool = False):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            if error:
+                self.errors += 1
+
+    @contextmanager
+    def time(self):
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.add(time.time() - start, error=True)
+            raise
+        self.add(time.time() - start)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                'count': self.count,
+                'errors': self.errors,
+                'avg': self.total / self.count if self.count else 0.0,
+                'max': self.max
+            }
+
+
+class Timings(object):
+    """Named group of Timing objects created on first use."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = {}
+
+    def __getitem__(self, name: str) -> Timing:
+        with self._lock:
+            if name not in self._timings:
+                self._timings[name] = Timing()
+            return self._timings[name]
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            timings = dict(self._timings)
+        return {name: timing.as_dict() for name, timing in timings.items()}
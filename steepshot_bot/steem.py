@@ -1,42 +1,126 @@
 import datetime
 import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
 
 from steep import Steem
 from steep.account import Account
-from steep.instance import set_shared_steemd_instance, shared_steemd_instance
+from steep.instance import set_shared_steemd_instance
 from steep.post import Post
 from steep.utils import derive_permlink
 from steepbase.exceptions import AccountDoesNotExistsException, InvalidWifError, PostDoesNotExist, \
     AlreadyVotedSimilarily
 
-from steepshot_bot import settings
+from steepshot_bot import settings, stats, nodes
 from steepshot_bot.db import User
 from steepshot_bot.exceptions import SteemError, PostNotFound, VotedSimilarily
 from steepshot_bot.utils import construct_identifier
 
 logger = logging.getLogger(__name__)
 
+# The first created client also becomes the steem library default instance
+_shared_instance_set = threading.Event()
 
-def get_new_steem(nodes: list) -> Steem:
-    steem = Steem(nodes=nodes)
+
+def get_new_steem(nodes: list, no_broadcast: bool = False) -> Steem:
+    steem = Steem(nodes=nodes, no_broadcast=no_broadcast)
 
     del (
         steem.commit.wallet.keyStorage,
         steem.commit.wallet.configStorage,
         steem.commit.wallet.MasterPassword,
     )
-    steem.accounts = set()
     steem.__class__.__name__ = 'Steem'
-    set_shared_steemd_instance(steem)
-    return shared_steemd_instance()
+    if not _shared_instance_set.is_set():
+        _shared_instance_set.set()
+        set_shared_steemd_instance(steem)
+    return steem
+
 
+class SteemPool(object):
+    """
+    Steem clients created on demand, up to `size` of them. A client is used by
+    one thread at a time, so its settings are never changed under another request.
+    Private keys are kept by the steem Wallet class and shared by all clients.
+    Clients are recreated when the node manager changes the order of nodes.
+    """
 
-steem_obj = get_new_steem(settings.STEEM_NODES)
+    def __init__(self, name: str, size: int, no_broadcast: bool):
+        self.name = name
+        self.size = size
+        self.no_broadcast = no_broadcast
+        self.wait = stats.Timing()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def client(self):
+        start = time.time()
+        steem = self._checkout()
+        self.wait.add(time.time() - start)
+        try:
+            yield steem
+        finally:
+            self._idle.put(steem)
+
+    def _checkout(self) -> Steem:
+        try:
+            steem = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                return self._create()
+            steem = self._idle.get()
+        if steem.nodes_generation != nodes.manager.generation:
+            logger.info('Steem nodes order changed, recreating client of pool "%s"', self.name)
+            nodes.close_client(steem)
+            return self._create()
+        return steem
+
+    def _create(self) -> Steem:
+        """Creates a client in an already reserved slot of the pool."""
+        logger.info('Creating Steem client for pool "%s"', self.name)
+        try:
+            generation = nodes.manager.generation
+            steem = get_new_steem(nodes.manager.ordered(), no_broadcast=self.no_broadcast)
+            steem.nodes_generation = generation
+            return steem
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def as_dict(self) -> dict:
+        return {
+            'size': self.size,
+            'created': self._created,
+            'idle': self._idle.qsize(),
+            'wait': self.wait.as_dict()
+        }
+
+
+# Clients that only sign transactions and never broadcast them, also used for reading
+signing_clients = SteemPool('signing', settings.STEEM_POOL_SIZE, no_broadcast=True)
+broadcast_clients = SteemPool('broadcast', settings.STEEM_POOL_SIZE, no_broadcast=False)
+stats.register('steem_pools', lambda: {
+    'signing': signing_clients.as_dict(),
+    'broadcast': broadcast_clients.as_dict()
+})
+
+_logged_in_accounts = set()
+_accounts_lock = threading.Lock()
 
 
 def account_exists(username: str) -> bool:
     try:
-        Account(username, steemd_instance=steem_obj)
+        with signing_clients.client() as steem:
+            Account(username, steemd_instance=steem)
         return True
     except AccountDoesNotExistsException as e:
         return False
@@ -44,25 +128,27 @@ def account_exists(username: str) -> bool:
 
 def get_signed_transaction(username):
     username_to_follow = 'steepshot'
-    steem_obj.commit.no_broadcast = True
-    trx = steem_obj.commit.follow(username_to_follow, ['blog'], username)
-    steem_obj.commit.no_broadcast = False
-    return trx
+    with signing_clients.client() as steem:
+        return steem.commit.follow(username_to_follow, ['blog'], username)
 
 
 def _add_posting_key(wif: str):
     logger.info('Adding local steem posting key')
-    steem_obj.commit.wallet.setKeys(wif)
+    with signing_clients.client() as steem:
+        steem.commit.wallet.setKeys(wif)
 
 
 def _validate_posting_key(username: str):
     try:
         trx = get_signed_transaction(username)
-        if not trx or not trx.get('signatures') or not steem_obj.verify_authority(trx):
+        with signing_clients.client() as steem:
+            verified = steem.verify_authority(trx)
+        if not trx or not trx.get('signatures') or not verified:
             raise InvalidWifError()
 
         logger.info('Adding user to local steem accounts: %s', username)
-        steem_obj.accounts.add(username)
+        with _accounts_lock:
+            _logged_in_accounts.add(username)
     except Exception:
         raise InvalidWifError()
 
@@ -76,14 +162,17 @@ def login(username: str, wif: str):
 
 
 def logout(user: User):
-    a = Account(user.name, steemd_instance=steem_obj)
-    posting_ppk = a['posting']['key_auths'][0][0]
-    steem_obj.commit.wallet.keys.pop(posting_ppk, None)
+    with signing_clients.client() as steem:
+        a = Account(user.name, steemd_instance=steem)
+        posting_ppk = a['posting']['key_auths'][0][0]
+        steem.commit.wallet.keys.pop(posting_ppk, None)
+    with _accounts_lock:
+        _logged_in_accounts.discard(user.name)
     user.delete_instance()
 
 
 def is_user_logged_in(username: str) -> bool:
-    return username in steem_obj.accounts
+    return username in _logged_in_accounts
 
 
 def add_post_to_steem(data: dict) -> str:
@@ -95,14 +184,15 @@ def add_post_to_steem(data: dict) -> str:
     author = payload.pop('username', '')
     permlink = derive_permlink(payload.get('title') + ' ' + datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
     try:
-        steem_obj.commit.post(
-            json_metadata=meta,
-            author=author,
-            self_vote=True,
-            permlink=permlink,
-            beneficiaries=beneficiaries,
-            **payload
-        )
+        with broadcast_clients.client() as steem:
+            steem.commit.post(
+                json_metadata=meta,
+                author=author,
+                self_vote=True,
+                permlink=permlink,
+                beneficiaries=beneficiaries,
+                **payload
+            )
         return construct_identifier(author, permlink)
     except Exception as e:
         logger.error('Failed to add post to Steem: %s', e)
@@ -111,8 +201,9 @@ def add_post_to_steem(data: dict) -> str:
 
 def upvote_post(identifier, username):
     try:
-        p = Post(identifier, steemd_instance=steem_obj)
-        p.upvote(voter=username)
+        with broadcast_clients.client() as steem:
+            p = Post(identifier, steemd_instance=steem)
+            p.upvote(voter=username)
     except PostDoesNotExist:
         raise PostNotFound('This post does not exists: "%s"' % identifier)
     except AlreadyVotedSimilarily:
@@ -121,8 +212,9 @@ def upvote_post(identifier, username):
 
 def add_comment(identifier, username, message):
     try:
-        p = Post(identifier, steemd_instance=steem_obj)
-        p.reply(message, author=username)
+        with broadcast_clients.client() as steem:
+            p = Post(identifier, steemd_instance=steem)
+            p.reply(message, author=username)
     except PostDoesNotExist:
         raise PostNotFound('This post does not exists: "%s"' % identifier)
     except Exception as e:
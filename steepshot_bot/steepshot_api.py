@@ -1,15 +1,25 @@
 import json
 import logging
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from requests_toolbelt import MultipartEncoder
 
-from steepshot_bot import settings
+from steepshot_bot import settings, stats
 from steepshot_bot.exceptions import SteepshotServerError
 from steepshot_bot.steem import get_signed_transaction
 
 logger = logging.getLogger(__name__)
 
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=settings.STEEPSHOT_API_POOL_SIZE))
+session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=settings.STEEPSHOT_API_POOL_SIZE))
+
+timings = stats.Timings()
+stats.register('steepshot_api', timings.as_dict)
+
 
 API_URLS = {
     'posts_recent': settings.STEEPSHOT_API + '/v1_1/recent',
@@ -22,42 +32,67 @@ API_URLS = {
 }
 
 
-def get_recent_posts(username: str) -> list:
+def _request(method: str, endpoint: str, url: str = None, **kwargs) -> requests.Response:
+    timeout = settings.STEEPSHOT_API_TIMEOUTS.get(endpoint, settings.STEEPSHOT_API_TIMEOUTS['default'])
+    start = time.time()
     try:
-        return requests.get(API_URLS['posts_recent'], params={'username': username}).json().get('results', [])
+        resp = session.request(method, url or API_URLS[endpoint], timeout=timeout, **kwargs)
+    except RequestException:
+        timings[endpoint].add(time.time() - start, error=True)
+        raise
+    timings[endpoint].add(time.time() - start, error=resp.status_code >= 500)
+    return resp
+
+
+def feed_params(username: str, offset: str, limit: int) -> dict:
+    """offset is the url of the post to continue from, it is returned again as the first result"""
+    params = {'username': username}
+    if offset:
+        params['offset'] = offset
+    if limit:
+        params['limit'] = limit
+    return params
+
+
+def get_recent_posts(username: str, offset: str = None, limit: int = None) -> list:
+    try:
+        return _request('GET', 'posts_recent', params=feed_params(username, offset, limit)).json().get('results', [])
     except RequestException as error:
         logger.error('Failed to retrieve data from api: {error}'.format(error=error))
         return []
 
 
-def get_new_posts(username: str) -> list:
+def get_new_posts(username: str, offset: str = None, limit: int = None) -> list:
     try:
-        return requests.get(API_URLS['posts_new'], params={'username': username}).json().get('results', [])
+        return _request('GET', 'posts_new', params=feed_params(username, offset, limit)).json().get('results', [])
     except RequestException as error:
         logger.error('Failed to retrieve data from api: {error}'.format(error=error))
         return []
 
 
-def get_hot_posts(username: str) -> list:
+def get_hot_posts(username: str, offset: str = None, limit: int = None) -> list:
     try:
-        return requests.get(API_URLS['posts_hot'], params={'username': username}).json().get('results', [])
+        return _request('GET', 'posts_hot', params=feed_params(username, offset, limit)).json().get('results', [])
     except RequestException as error:
         logger.error('Failed to retrieve data from api: {error}'.format(error=error))
         return []
 
 
-def get_top_posts(username: str) -> list:
+def get_top_posts(username: str, offset: str = None, limit: int = None) -> list:
     try:
-        return requests.get(API_URLS['posts_top'], params={'username': username}).json().get('results', [])
+        return _request('GET', 'posts_top', params=feed_params(username, offset, limit)).json().get('results', [])
     except RequestException as error:
         logger.error('Failed to retrieve data from api: {error}'.format(error=error))
         return []
 
 
 def post_prepare(photo, title: str, username: str, tags: list = None):
+    """
+    photo is bytes or a file object, file objects are streamed without reading them into memory.
+    Objects with a `len` attribute and no fileno(), like uploads.UploadReader, are read as they are.
+    """
     try:
         trx = get_signed_transaction(username)
-        files = {'photo': photo}
         payload = [
             ('title', title),
             ('username', username),
@@ -66,7 +101,9 @@ def post_prepare(photo, title: str, username: str, tags: list = None):
         if tags:
             for tag in tags:
                 payload.append(('tags', tag))
-        resp = requests.post(API_URLS['post_prepare'], data=payload, files=files)
+        payload.append(('photo', ('photo', photo)))
+        body = MultipartEncoder(fields=payload)
+        resp = _request('POST', 'post_prepare', data=body, headers={'Content-Type': body.content_type})
         return resp.json()
     except RequestException as e:
         logger.error('Failed to retrieve data from api: %s', e)
@@ -79,10 +116,10 @@ def log_new_post(username: str, error_occured: str = None):
             'username': username,
             'error': error_occured
         }
-        return requests.post(API_URLS['log_post'], data=payload).json()
+        return _request('POST', 'log_post', data=payload).json()
     except RequestException as error:
         logger.error('Failed to retrieve data from api: {error}'.format(error=error))
-        return []
+        raise SteepshotServerError(error)
 
 
 def log_upvote_post(identifier: str, username: str, error_occured: str = None):
@@ -91,7 +128,7 @@ def log_upvote_post(identifier: str, username: str, error_occured: str = None):
             'username': username,
             'error': error_occured
         }
-        return requests.post(API_URLS['log_upvote'] % identifier, data=payload).json()
+        return _request('POST', 'log_upvote', API_URLS['log_upvote'] % identifier, data=payload).json()
     except RequestException as error:
         logger.error('Failed to retrieve data from api: {error}'.format(error=error))
         raise SteepshotServerError(error)
@@ -0,0 +1,240 @@
+import copy
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+import requests
+import telebot
+from telebot.apihelper import FILE_URL
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from steepshot_bot import settings, stats
+from steepshot_bot.cache import LRUCache
+from steepshot_bot.exceptions import ImageTooLarge
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_TIMEOUT = (3.05, 30)
+
+session = requests.Session()
+
+
+class MemoryGauge(object):
+    """Bytes of photos currently held in memory by this process and the peak value."""
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def add(self, size: int):
+        with self._lock:
+            self.current += size
+            self.peak = max(self.peak, self.current)
+
+    def as_dict(self) -> dict:
+        return {
+            'pid': os.getpid(),
+            'current': self.current,
+            'peak': self.peak
+        }
+
+
+class UploadStats(object):
+    def __init__(self):
+        self.uploads = stats.Timing()
+        self.bytes = 0
+        self.normalised = 0
+        self.bytes_saved = 0
+
+    def add_upload(self, size: int, seconds: float, error: bool = False):
+        self.uploads.add(seconds, error=error)
+        self.bytes += size
+
+    def add_normalised(self, original_size: int, size: int):
+        self.normalised += 1
+        self.bytes_saved += original_size - size
+
+    def as_dict(self) -> dict:
+        result = self.uploads.as_dict()
+        result.update({
+            'bytes': self.bytes,
+            'avg_bytes': self.bytes / result['count'] if result['count'] else 0,
+            'normalised': self.normalised,
+            'bytes_saved': self.bytes_saved
+        })
+        return result
+
+
+class UploadIndex(object):
+    """
+    Remembers recently prepared uploads by user and content hash, so a photo sent
+    again with the same title after a failure is not downloaded and uploaded twice.
+    Telegram file_ids are mapped to content hashes to skip the download as well.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.hits = 0
+        self._digests = LRUCache(size, ttl)
+        self._prepared = LRUCache(size, ttl)
+
+    def get_digest(self, username: str, file_id: str):
+        return self._digests.get((username, file_id))
+
+    def set_digest(self, username: str, file_id: str, digest: str):
+        self._digests.set((username, file_id), digest)
+
+    def get_prepared(self, username: str, digest: str, title: str):
+        data = self._prepared.get((username, digest, title))
+        if data is None:
+            return None
+        self.hits += 1
+        # Prepared data is consumed destructively when the post is broadcast
+        return copy.deepcopy(data)
+
+    def set_prepared(self, username: str, digest: str, title: str, data: dict):
+        self._prepared.set((username, digest, title), copy.deepcopy(data))
+
+    def discard(self, username: str, digest: str, title: str):
+        self._prepared.pop((username, digest, title))
+
+    def as_dict(self) -> dict:
+        return {
+            'size': len(self._prepared),
+            'hits': self.hits
+        }
+
+
+memory = MemoryGauge()
+upload_stats = UploadStats()
+upload_index = UploadIndex(settings.UPLOAD_DEDUP_SIZE, settings.UPLOAD_DEDUP_TTL)
+stats.register('upload_memory', memory.as_dict)
+stats.register('uploads', upload_stats.as_dict)
+stats.register('upload_index', upload_index.as_dict)
+
+
+class UploadReader(object):
+    """
+    Reads a PhotoFile for MultipartEncoder. It has no fileno(), which would move a
+    spooled file to disk, and tells the encoder the number of bytes left instead.
+    """
+
+    def __init__(self, photo: 'PhotoFile'):
+        self._file = photo.rewind()
+        self.len = photo.size
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._file.read(size)
+        self.len -= len(chunk)
+        return chunk
+
+
+class PhotoFile(object):
+    """
+    Downloaded photo kept in a spooled temporary file, which moves to disk once
+    it grows over UPLOAD_SPOOL_SIZE bytes. Only write() and reader() keep it in
+    memory, calling fileno() on the file moves it to disk as well.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=settings.UPLOAD_SPOOL_SIZE)
+        self._hash = hashlib.sha256()
+        self._in_memory = 0
+
+    @property
+    def digest(self) -> str:
+        """Hash of the content written by write()"""
+        return self._hash.hexdigest()
+
+    def write(self, chunk: bytes):
+        if self.size + len(chunk) > settings.UPLOAD_MAX_SIZE:
+            raise ImageTooLarge('more than {} bytes'.format(settings.UPLOAD_MAX_SIZE))
+        self.file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        self.track()
+
+    def track(self):
+        # SpooledTemporaryFile moves to disk once a write leaves it larger than max_size
+        in_memory = 0 if self.size > settings.UPLOAD_SPOOL_SIZE else self.size
+        memory.add(in_memory - self._in_memory)
+        self._in_memory = in_memory
+
+    def rewind(self):
+        self.file.seek(0)
+        return self.file
+
+    def reader(self) -> UploadReader:
+        """The content from the start for uploading"""
+        return UploadReader(self)
+
+    def close(self):
+        self.file.close()
+        memory.add(-self._in_memory)
+        self._in_memory = 0
+
+
+def choose_photo_size(sizes: list) -> telebot.types.PhotoSize:
+    """The smallest size covering IMAGE_TARGET_SIZE on its longer side, the largest one otherwise."""
+    sizes = sorted(sizes, key=lambda x: x.file_size or 0)
+    if settings.IMAGE_TARGET_SIZE:
+        for size in sizes:
+            if max(size.width, size.height) >= settings.IMAGE_TARGET_SIZE:
+                return size
+    return sizes[-1]
+
+
+def normalise_photo(photo: PhotoFile) -> PhotoFile:
+    """
+    Downscales and recompresses photos larger than IMAGE_TARGET_SIZE.
+    Returns the photo unchanged if Pillow is not installed or nothing is to be done.
+    """
+    if Image is None or not settings.IMAGE_TARGET_SIZE:
+        return photo
+    image = Image.open(photo.rewind())
+    if max(image.size) <= settings.IMAGE_TARGET_SIZE:
+        return photo
+
+    image.thumbnail((settings.IMAGE_TARGET_SIZE, settings.IMAGE_TARGET_SIZE), Image.LANCZOS)
+    result = PhotoFile()
+    try:
+        # Saved through write(): Pillow writes to fileno() of files which have one
+        image.convert('RGB').save(result, 'JPEG', quality=settings.IMAGE_JPEG_QUALITY, optimize=True)
+    except Exception:
+        result.close()
+        raise
+    if result.size >= photo.size:
+        result.close()
+        return photo
+    upload_stats.add_normalised(photo.size, result.size)
+    photo.close()
+    return result
+
+
+def download_photo(bot: telebot.TeleBot, file_id: str) -> PhotoFile:
+    """
+    Raises ImageTooLarge, requests.RequestException
+    """
+    file_info = bot.get_file(file_id)
+    if file_info.file_size and file_info.file_size > settings.UPLOAD_MAX_SIZE:
+        raise ImageTooLarge('{} bytes'.format(file_info.file_size))
+
+    photo = PhotoFile()
+    try:
+        url = FILE_URL.format(bot.token, file_info.file_path)
+        with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as resp:
+            resp.raise_for_status()
+            for chunk in resp.iter_content(settings.UPLOAD_CHUNK_SIZE):
+                photo.write(chunk)
+    except Exception:
+        photo.close()
+        raise
+    photo.rewind()
+    return photo
@@ -0,0 +1,68 @@
+import datetime
+import logging
+import threading
+
+from peewee import Case
+
+from steepshot_bot import settings, stats
+from steepshot_bot.cache import LRUCache
+from steepshot_bot.db import User, connection
+from steepshot_bot.workers import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+_cache = LRUCache(settings.USER_CACHE_SIZE)
+_activity = {}
+_activity_lock = threading.Lock()
+
+
+def get_user(user_id: int) -> User:
+    """
+    Raises DoesNotExist
+    """
+    user = _cache.get(user_id)
+    if user is None:
+        user = User.get(User.id == user_id)
+        _cache.set(user_id, user)
+    return user
+
+
+def invalidate(user_id: int):
+    _cache.pop(user_id)
+
+
+def touch(user: User):
+    """Records user activity, it is written to the database by flush_activity()."""
+    user.last_action_time = datetime.datetime.now()
+    with _activity_lock:
+        _activity[user.id] = user.last_action_time
+
+
+def flush_activity():
+    global _activity
+
+    with _activity_lock:
+        pending, _activity = _activity, {}
+    if not pending:
+        return
+    try:
+        with connection():
+            User.update(
+                last_action_time=Case(User.id, list(pending.items()))
+            ).where(User.id.in_(list(pending))).execute()
+    except Exception as e:
+        logger.error('Failed to save activity of %s users: %s', len(pending), e)
+        with _activity_lock:
+            for user_id, action_time in pending.items():
+                _activity.setdefault(user_id, action_time)
+
+
+def as_dict() -> dict:
+    return {
+        'cached': len(_cache),
+        'pending_activity': len(_activity)
+    }
+
+
+activity_flusher = PeriodicTask('user-activity', settings.USER_ACTIVITY_FLUSH_INTERVAL, flush_activity)
+stats.register('users', as_dict)
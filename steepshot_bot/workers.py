@@ -0,0 +1,145 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+from steepshot_bot.stats import Timing
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool(object):
+    """
+    Fixed number of daemon threads executing callables from a queue.
+    Threads are started on the first submit.
+    """
+
+    def __init__(self, name: str, size: int, queue_size: int = 0):
+        self.name = name
+        self.size = size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.size):
+                thread = threading.Thread(target=self._work, name='{}-{}'.format(self.name, i), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, func, *args, **kwargs):
+        """Raises queue.Full if the pool queue is bounded and full."""
+        self.start()
+        self._queue.put_nowait((func, args, kwargs))
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            func, args, kwargs = self._queue.get()
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logger.exception('Unhandled error in worker "%s": %s', self.name, e)
+            finally:
+                self._queue.task_done()
+
+
+class KeyedDispatcher(object):
+    """
+    Runs tasks on a worker pool. Tasks submitted with the same key are executed
+    one at a time in submission order, tasks with different keys run concurrently.
+    """
+
+    def __init__(self, name: str, workers: int, queue_size: int):
+        self.queue_size = queue_size
+        self.wait = Timing()
+        self.latency = Timing()
+        self._pool = WorkerPool(name, workers)
+        self._pending = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def submit(self, key, func, *args, **kwargs):
+        """Raises queue.Full when queue_size tasks are already waiting or running."""
+        task = (time.time(), func, args, kwargs)
+        with self._lock:
+            if self._size >= self.queue_size:
+                raise queue.Full()
+            self._size += 1
+            if key in self._pending:
+                self._pending[key].append(task)
+                return
+            self._pending[key] = deque([task])
+        self._pool.submit(self._run, key)
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._size
+
+    def _run(self, key):
+        with self._lock:
+            enqueued, func, args, kwargs = self._pending[key][0]
+        started = time.time()
+        self.wait.add(started - enqueued)
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            self.latency.add(time.time() - started, error=True)
+            logger.exception('Failed to process task for key %s: %s', key, e)
+        else:
+            self.latency.add(time.time() - started)
+        with self._lock:
+            self._size -= 1
+            tasks = self._pending[key]
+            tasks.popleft()
+            if not tasks:
+                del self._pending[key]
+                return
+        # Requeue instead of looping so a busy key does not hold a thread forever
+        self._pool.submit(self._run, key)
+
+    def as_dict(self) -> dict:
+        return {
+            'depth': self.depth(),
+            'wait': self.wait.as_dict(),
+            'latency': self.latency.as_dict()
+        }
+
+
+class PeriodicTask(object):
+    """Calls func every `interval` seconds in a daemon thread until stopped."""
+
+    def __init__(self, name: str, interval: float, func, run_at_start: bool = False):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.run_at_start = run_at_start
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _loop(self):
+        if self.run_at_start:
+            self._run()
+        while not self._stopped.wait(self.interval):
+            self._run()
+
+    def _run(self):
+        try:
+            self.func()
+        except Exception as e:
+            logger.exception('Periodic task "%s" failed: %s', self.name, e)
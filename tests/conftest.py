@@ -0,0 +1,16 @@
+import pytest
+from peewee import SqliteDatabase
+
+from steepshot_bot import db
+
+
+@pytest.fixture
+def database(tmpdir, monkeypatch):
+    """SQLite database with all tables, used by the models and db.connection()"""
+    database = SqliteDatabase(str(tmpdir.join('test.db')))
+    monkeypatch.setattr(db, 'db', database)
+    db.database_proxy.initialize(database)
+    db.create_tables()
+    yield database
+    if not database.is_closed():
+        database.close()
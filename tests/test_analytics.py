@@ -0,0 +1,36 @@
+import datetime
+
+from steepshot_bot import analytics, db
+from steepshot_bot.db import AnalyticsEvent
+
+
+def test_claimed_events_are_skipped(database):
+    with db.connection():
+        for username in ('a', 'b'):
+            AnalyticsEvent.create(kind=analytics.NEW_POST, username=username)
+        now = datetime.datetime.now()
+        assert [event.username for event in analytics._claim(now)] == ['a', 'b']
+        # Another process runs while the batch is being sent
+        assert analytics._claim(now) == []
+
+
+def test_send_pending(database, monkeypatch):
+    sent = []
+
+    def send(event):
+        if event.username == 'fails':
+            raise IOError('unavailable')
+        sent.append(event.username)
+
+    monkeypatch.setattr(analytics, '_send', send)
+    with db.connection():
+        AnalyticsEvent.create(kind=analytics.NEW_POST, username='a')
+        AnalyticsEvent.create(kind=analytics.NEW_POST, username='fails')
+        AnalyticsEvent.create(kind=analytics.NEW_POST, username='claimed',
+                              next_attempt_at=datetime.datetime.now() + datetime.timedelta(minutes=5))
+    analytics.send_pending()
+    assert sent == ['a']
+    with db.connection():
+        failed = AnalyticsEvent.get(AnalyticsEvent.username == 'fails')
+        assert failed.attempts == 1
+        assert AnalyticsEvent.select().count() == 2
@@ -0,0 +1,46 @@
+import pytest
+
+from steepshot_bot import callbacks, settings
+
+
+@pytest.fixture(autouse=True)
+def secret(monkeypatch):
+    monkeypatch.setattr(settings, 'CALLBACK_SECRET', 'test-secret')
+
+
+def test_encode_decode():
+    data = callbacks.encode('upvote', '@author/some-permlink')
+    assert data.startswith('u:author/some-permlink:')
+    assert callbacks.get_action(data) == 'upvote'
+    assert callbacks.decode(data) == '@author/some-permlink'
+
+
+def test_encode_too_long():
+    assert callbacks.encode('comment', '@author/' + 'x' * 64) is None
+    assert not callbacks.fits('@author/' + 'x' * 64)
+
+
+def test_decode_tampered_signature():
+    data = callbacks.encode('upvote', '@author/permlink')
+    code, identifier, signature = data.split(':')
+    assert callbacks.decode(':'.join([code, identifier, 'A' * len(signature)])) is None
+    assert callbacks.decode(':'.join([code, 'author/other', signature])) is None
+    assert callbacks.decode(':'.join(['c', identifier, signature])) is None
+
+
+def test_decode_other_secret(monkeypatch):
+    data = callbacks.encode('upvote', '@author/permlink')
+    monkeypatch.setattr(settings, 'CALLBACK_SECRET', 'rotated')
+    assert callbacks.decode(data) is None
+
+
+def test_legacy_message_id():
+    assert callbacks.decode('upvote') is None
+    assert callbacks.get_legacy_message_id('upvote', 7) == 7
+    assert callbacks.get_legacy_message_id('comment:42', 7) == 42
+
+
+@pytest.mark.parametrize('data', ['u:author/permlink:BADSIGxx', 'upvote:abc', 'more:token', ''])
+def test_legacy_message_id_invalid(data):
+    with pytest.raises(ValueError):
+        callbacks.get_legacy_message_id(data, 7)
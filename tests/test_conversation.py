@@ -0,0 +1,31 @@
+from steepshot_bot import db
+from steepshot_bot.conversation import DatabaseStore
+
+
+def test_dialog_set_by_another_process(database):
+    first, second = DatabaseStore(cache=False), DatabaseStore(cache=False)
+    with db.connection():
+        assert first.get(1) is None
+        second.set(1, 'comment', {'identifier': '@a/b'})
+        assert first.get(1)[:2] == ('comment', {'identifier': '@a/b'})
+
+
+def test_pop_is_claimed_once(database):
+    first, second = DatabaseStore(cache=False), DatabaseStore(cache=False)
+    with db.connection():
+        first.set(1, 'comment', {})
+        assert first.pop(1)[0] == 'comment'
+        assert second.pop(1) is None
+
+
+def test_pop_keeps_dialog_set_again(database, monkeypatch):
+    store = DatabaseStore(cache=False)
+    with db.connection():
+        store.set(1, 'comment', {})
+        loaded = store._load(1)
+        store.set(1, 'title', {})
+        # Another process sets the next step between loading and deleting
+        monkeypatch.setattr(store, '_load', lambda user_id: loaded)
+        assert store.pop(1) is None
+        monkeypatch.undo()
+        assert store.get(1)[0] == 'title'
@@ -0,0 +1,63 @@
+import datetime
+import threading
+
+import pytest
+from playhouse.pool import PooledSqliteDatabase
+
+from steepshot_bot import db, settings
+
+
+@pytest.fixture
+def pool(tmpdir, monkeypatch):
+    """Pool of one connection, taken by another thread until the test releases it"""
+    database = PooledSqliteDatabase(str(tmpdir.join('pool.db')), max_connections=1, check_same_thread=False)
+    monkeypatch.setattr(db, 'db', database)
+    monkeypatch.setattr(settings, 'DATABASE_POOL_TIMEOUT', 0.2)
+    taken, release = threading.Event(), threading.Event()
+
+    def hold():
+        with db.connection():
+            taken.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    taken.wait()
+    yield release
+    release.set()
+    holder.join()
+    database.close_all()
+
+
+def test_checkout_waits_for_released_connection(pool):
+    threading.Timer(0.05, pool.set).start()
+    with db.connection() as database:
+        assert not database.is_closed()
+
+
+def test_exhausted_pool_is_retried(pool, monkeypatch):
+    monkeypatch.setattr(settings, 'DATABASE_CHECKOUT_ATTEMPTS', 2)
+    calls = []
+    with pytest.raises(db.MaxConnectionsExceeded):
+        db.call_with_connection(calls.append, 1)
+    assert calls == []
+    assert db.checkout_wait.as_dict()['errors'] >= 2
+
+    pool.set()
+    db.call_with_connection(calls.append, 1)
+    assert calls == [1]
+
+
+def test_exclusive_task_runs_in_lease_holder(database, monkeypatch):
+    calls = []
+    task = db.exclusive('task', 60)(lambda: calls.append(db.LEASE_OWNER))
+    task()
+    monkeypatch.setattr(db, 'LEASE_OWNER', 'other:1')
+    task()
+    assert len(calls) == 1
+
+    # Taken over once the holder stops renewing the lease
+    with db.connection():
+        db.TaskLease.update(expires_at=datetime.datetime.now() - datetime.timedelta(seconds=1)).execute()
+    task()
+    assert calls[-1] == 'other:1'
@@ -0,0 +1,77 @@
+import pytest
+
+from steepshot_bot import dedup
+from steepshot_bot.dedup import UpdateDeduplicator
+
+
+class FakeTime(object):
+    def __init__(self, now: float):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime(1000.0)
+    monkeypatch.setattr(dedup, 'time', clock)
+    return clock
+
+
+def test_duplicate_within_ttl(clock):
+    deduplicator = UpdateDeduplicator(size=10, ttl=60)
+    assert not deduplicator.is_duplicate(1)
+    clock.now += 30
+    assert deduplicator.is_duplicate(1)
+    assert deduplicator.dropped == 1
+
+
+def test_ttl_eviction(clock):
+    deduplicator = UpdateDeduplicator(size=10, ttl=60)
+    deduplicator.is_duplicate(1)
+    clock.now += 61
+    # Expired ids are dropped when a new update arrives
+    assert not deduplicator.is_duplicate(2)
+    assert not deduplicator.is_duplicate(1)
+
+
+def test_size_eviction(clock):
+    deduplicator = UpdateDeduplicator(size=3, ttl=60)
+    for update_id in range(1, 5):
+        assert not deduplicator.is_duplicate(update_id)
+    assert deduplicator.as_dict()['size'] == 3
+    assert not deduplicator.is_duplicate(1)
+    assert deduplicator.is_duplicate(4)
+
+
+def test_forget(clock):
+    deduplicator = UpdateDeduplicator(size=10, ttl=60)
+    deduplicator.is_duplicate(1)
+    deduplicator.forget(1)
+    assert not deduplicator.is_duplicate(1)
+
+
+def test_shared_between_processes(clock, database):
+    first = UpdateDeduplicator(size=10, ttl=60, shared=True)
+    second = UpdateDeduplicator(size=10, ttl=60, shared=True)
+    assert not first.is_duplicate(1)
+    # Redelivered to another webhook process
+    assert second.is_duplicate(1)
+    assert second.dropped == 1
+
+    first.forget(1)
+    assert not second.is_duplicate(1)
+
+
+def test_prune(clock, database):
+    deduplicator = UpdateDeduplicator(size=10, ttl=60, shared=True)
+    deduplicator.is_duplicate(1)
+    clock.now += 50
+    deduplicator.is_duplicate(2)
+    clock.now += 20
+    deduplicator.prune()
+    # Update 1 expired, a restarted process accepts it again
+    restarted = UpdateDeduplicator(size=10, ttl=60, shared=True)
+    assert not restarted.is_duplicate(1)
+    assert restarted.is_duplicate(2)
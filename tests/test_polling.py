@@ -0,0 +1,117 @@
+import queue
+
+from steepshot_bot.polling import Poller
+
+
+class Update(object):
+    def __init__(self, update_id: int):
+        self.update_id = update_id
+
+
+class ManualDispatcher(object):
+    """Keeps submitted tasks until the test runs them"""
+
+    def __init__(self, capacity: int = 100):
+        self.capacity = capacity
+        self.tasks = {}
+
+    def submit(self, key, func, update):
+        if len(self.tasks) >= self.capacity:
+            raise queue.Full()
+        self.tasks[update.update_id] = (func, update)
+
+    def run(self, update_id: int):
+        func, update = self.tasks.pop(update_id)
+        func(update)
+
+
+def create_poller(dispatcher: ManualDispatcher, handled: list) -> Poller:
+    return Poller(None, dispatcher, lambda update: handled.append(update.update_id),
+                  lambda update: update.update_id, timeout=0, limit=100)
+
+
+def updates(*update_ids) -> list:
+    return [Update(update_id) for update_id in update_ids]
+
+
+def test_offset_waits_for_oldest_pending_update():
+    dispatcher, handled = ManualDispatcher(), []
+    poller = create_poller(dispatcher, handled)
+    assert poller._submit(updates(1, 2, 3)) == 3
+
+    dispatcher.run(2)
+    assert poller._offset == 1
+    dispatcher.run(1)
+    assert poller._offset == 3
+    dispatcher.run(3)
+    assert poller._offset == 4
+    assert handled == [2, 1, 3]
+
+
+def test_updates_in_progress_or_done_are_not_taken_again():
+    dispatcher, handled = ManualDispatcher(), []
+    poller = create_poller(dispatcher, handled)
+    poller._submit(updates(1, 2))
+    dispatcher.run(2)
+    # Both come again while 1 keeps the offset down
+    assert poller._submit(updates(1, 2, 3)) == 1
+    dispatcher.run(1)
+    dispatcher.run(3)
+    assert handled == [2, 1, 3]
+    assert poller._offset == 4
+
+
+def test_stale_batch_is_skipped():
+    dispatcher, handled = ManualDispatcher(), []
+    poller = create_poller(dispatcher, handled)
+    poller._submit(updates(1, 2))
+    dispatcher.run(1)
+    dispatcher.run(2)
+    # Requested before the offset moved past the handled updates
+    assert poller._submit(updates(1, 2)) == 0
+    assert handled == [1, 2]
+
+
+def test_full_queue_leaves_updates_for_next_batch():
+    dispatcher, handled = ManualDispatcher(capacity=1), []
+    poller = create_poller(dispatcher, handled)
+    assert poller._submit(updates(1, 2)) == 1
+    dispatcher.run(1)
+    assert poller._offset == 2
+    assert poller._submit(updates(2)) == 1
+    dispatcher.run(2)
+    assert handled == [1, 2]
+    assert poller._offset == 3
+
+
+def test_slow_update_does_not_hold_back_offset():
+    dispatcher, handled = ManualDispatcher(), []
+    poller = create_poller(dispatcher, handled)
+    poller._submit(updates(1, 2, 3))
+    dispatcher.run(2)
+    dispatcher.run(3)
+    # Update 1 is slow, the next batch brings nothing new
+    batch = updates(1, 2, 3)
+    assert poller._submit(batch) == 0
+    assert poller._skip_taken(batch)
+    assert poller._offset == 4
+    assert poller.confirmed_early == 1
+
+    assert poller._submit(updates(4)) == 1
+    dispatcher.run(4)
+    dispatcher.run(1)
+    assert poller._offset == 5
+    assert handled == [2, 3, 4, 1]
+
+
+def test_skip_stops_at_update_not_taken():
+    dispatcher, handled = ManualDispatcher(capacity=1), []
+    poller = create_poller(dispatcher, handled)
+    poller._submit(updates(1, 2))
+    # The queue is full, update 2 was not taken and must be received again
+    assert poller._submit(updates(1, 2)) == 0
+    assert poller._skip_taken(updates(1, 2))
+    assert poller._offset == 2
+    assert not poller._skip_taken(updates(2))
+    dispatcher.run(1)
+    assert poller._offset == 2
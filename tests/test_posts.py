@@ -0,0 +1,48 @@
+import datetime
+
+from steepshot_bot import db
+from steepshot_bot.db import Identifier, Post
+
+
+def test_add_posts_retries_pruned_identifier(database, monkeypatch):
+    insert_posts = db._insert_posts
+    calls = []
+
+    def prune_then_insert(rows):
+        calls.append(rows)
+        if len(calls) == 1:
+            # Identifier created and pruned again before the posts are inserted
+            identifier_id = db.get_identifier_ids(['@a/b'])['@a/b']
+            Identifier.delete().where(Identifier.id == identifier_id).execute()
+            Post.insert(chat_id=1, message_id=1, identifier=identifier_id).execute()
+        else:
+            insert_posts(rows)
+
+    database.execute_sql('PRAGMA foreign_keys = ON')
+    monkeypatch.setattr(db, '_insert_posts', prune_then_insert)
+    with db.connection():
+        with database.atomic():
+            db.add_posts([(1, 1, '@a/b'), (1, 2, '@a/c')])
+            assert Post.select().count() == 2
+        assert len(calls) == 2
+        assert db.find_post_identifier(1, 1) == '@a/b'
+        assert Identifier.select().count() == 2
+
+
+def test_identifiers_are_resolved_in_bulk(database):
+    with db.connection():
+        Identifier.create(value='@a/b')
+        ids = db.get_identifier_ids(['@a/b', '@a/c', '@a/c'])
+        assert set(ids) == {'@a/b', '@a/c'}
+        assert Identifier.get(Identifier.value == '@a/b').id == ids['@a/b']
+        assert Identifier.select().count() == 2
+
+
+def test_prune_posts_removes_unused_identifiers_in_batches(database):
+    with db.connection():
+        db.add_posts([(1, message_id, '@a/post-{}'.format(message_id)) for message_id in range(5)])
+        Post.update(created_at=datetime.datetime.now() - datetime.timedelta(days=2)) \
+            .where(Post.message_id < 3).execute()
+        db.prune_posts(datetime.timedelta(days=1), batch_size=2)
+        assert Post.select().count() == 2
+        assert sorted(i.value for i in Identifier.select()) == ['@a/post-3', '@a/post-4']
@@ -0,0 +1,110 @@
+from steepshot_bot import db, seen as seen_posts
+from steepshot_bot.cache import LRUCache
+from steepshot_bot.seen import BloomFilter, SeenFilter
+
+
+def identifiers(prefix: str, count: int) -> list:
+    return ['@{}/post-{}'.format(prefix, i) for i in range(count)]
+
+
+def test_bloom_filter_error_rate():
+    bloom = BloomFilter(1000, 0.01)
+    for identifier in identifiers('seen', 1000):
+        bloom.add(identifier)
+    assert all(identifier in bloom for identifier in identifiers('seen', 1000))
+    false_positives = sum(identifier in bloom for identifier in identifiers('other', 10000))
+    assert false_positives < 300
+    assert bloom.is_full()
+
+
+def test_rotation_keeps_previous_filter():
+    seen = SeenFilter(100, 0.01)
+    first, second, third = identifiers('a', 100), identifiers('b', 100), identifiers('c', 100)
+    for identifier in first + second:
+        seen.add(identifier)
+    assert all(identifier in seen for identifier in first + second)
+
+    for identifier in third:
+        seen.add(identifier)
+    # The oldest filter is dropped when the current one fills again
+    assert sum(identifier in seen for identifier in first) < 10
+    assert all(identifier in seen for identifier in second + third)
+
+
+def test_adding_seen_identifier_does_not_fill_filter():
+    seen = SeenFilter(10, 0.01)
+    for _ in range(20):
+        seen.add('@a/post')
+    assert seen.current.count == 1
+    assert seen.previous is None
+
+
+def test_round_trip():
+    seen = SeenFilter(100, 0.01)
+    for identifier in identifiers('a', 150):
+        seen.add(identifier)
+    loaded = SeenFilter.from_bytes(100, 0.01, seen.to_bytes())
+    assert loaded.current.count == seen.current.count
+    assert loaded.previous.count == seen.previous.count
+    assert all(identifier in loaded for identifier in identifiers('a', 150))
+
+
+def test_other_settings_start_empty():
+    seen = SeenFilter(100, 0.01)
+    seen.add('@a/post')
+    loaded = SeenFilter.from_bytes(200, 0.01, seen.to_bytes())
+    assert '@a/post' not in loaded
+    assert loaded.capacity == 200
+
+
+def test_filters_are_sized_for_half_error_rate():
+    seen = SeenFilter(100, 0.02)
+    assert seen.current.size == BloomFilter(100, 0.01).size
+
+
+def test_merge_same_generation():
+    first, second = SeenFilter(100, 0.01), SeenFilter(100, 0.01)
+    first.add('@a/post')
+    second.add('@b/post')
+    first.merge(second)
+    assert '@a/post' in first and '@b/post' in first
+    assert first.current.count == 2
+
+
+def test_merge_rotated_copy():
+    first = SeenFilter(100, 0.01)
+    for identifier in identifiers('a', 50):
+        first.add(identifier)
+    second = SeenFilter.from_bytes(100, 0.01, first.to_bytes())
+    first.add('@b/post')
+    # The other copy fills its filter and rotates
+    for identifier in identifiers('c', 60):
+        second.add(identifier)
+    assert second.generation == 1
+
+    first.merge(second)
+    assert first.generation == 1
+    assert all(identifier in first for identifier in identifiers('a', 50) + identifiers('c', 60) + ['@b/post'])
+    # Merging the other way gives the same posts
+    second.merge(SeenFilter.from_bytes(100, 0.01, first.to_bytes()))
+    assert '@b/post' in second
+
+
+def test_flush_keeps_posts_marked_by_other_process(database, monkeypatch):
+    monkeypatch.setattr(seen_posts, '_cache', LRUCache(10))
+    monkeypatch.setattr(seen_posts, '_dirty', {})
+    with db.connection():
+        other = seen_posts.get_filter(1)
+        other = SeenFilter.from_bytes(other.capacity, other.error_rate, other.to_bytes())
+        seen_posts.add(1, ['@a/post'])
+        seen_posts.flush()
+
+        # Loaded by another process before the flush above, which it does not see
+        other.add('@b/post')
+        monkeypatch.setattr(seen_posts, '_cache', LRUCache(10))
+        monkeypatch.setattr(seen_posts, '_dirty', {1: other})
+        seen_posts.flush()
+
+        monkeypatch.setattr(seen_posts, '_cache', LRUCache(10))
+        stored = seen_posts.get_filter(1)
+    assert '@a/post' in stored and '@b/post' in stored
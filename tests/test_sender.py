@@ -0,0 +1,33 @@
+import pytest
+
+from steepshot_bot.sender import TokenBucket
+
+
+@pytest.fixture
+def bucket():
+    bucket = TokenBucket(rate=2, capacity=3)
+    bucket.updated = 100.0
+    return bucket
+
+
+def test_burst_up_to_capacity(bucket):
+    for _ in range(3):
+        assert bucket.delay(100.0) == 0
+        bucket.take()
+    assert bucket.delay(100.0) == pytest.approx(0.5)
+
+
+def test_refill_at_rate(bucket):
+    bucket.tokens = 0
+    assert bucket.delay(100.25) == pytest.approx(0.25)
+    assert bucket.delay(100.5) == 0
+    # Never more than capacity however long the bucket was idle
+    assert bucket.delay(1000.0) == 0
+    assert bucket.tokens == 3
+
+
+def test_reserve_queues_callers(bucket):
+    delays = [bucket.reserve(100.0) for _ in range(6)]
+    assert delays == pytest.approx([0, 0, 0, 0.5, 1.0, 1.5])
+    # Reserved tokens are paid back by the refill before new calls get one
+    assert bucket.reserve(101.0) == pytest.approx(1.0)
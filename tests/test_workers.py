@@ -0,0 +1,59 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from steepshot_bot.workers import KeyedDispatcher
+
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_tasks_of_one_key_run_in_order():
+    dispatcher = KeyedDispatcher('test', 4, 1000)
+    results = {key: [] for key in range(5)}
+    for i in range(50):
+        for key in results:
+            # Uneven durations would reorder tasks run concurrently
+            dispatcher.submit(key, lambda k, n: (time.sleep(0.001 * (n % 3)), results[k].append(n)), key, i)
+    wait_for(lambda: dispatcher.depth() == 0)
+    for key, numbers in results.items():
+        assert numbers == list(range(50))
+
+
+def test_keys_run_concurrently():
+    dispatcher = KeyedDispatcher('test', 2, 10)
+    blocked = threading.Event()
+    done = threading.Event()
+    dispatcher.submit('slow', blocked.wait, 5)
+    dispatcher.submit('fast', done.set)
+    assert done.wait(5)
+    blocked.set()
+    wait_for(lambda: dispatcher.depth() == 0)
+
+
+def test_failing_task_does_not_stop_its_key():
+    dispatcher = KeyedDispatcher('test', 1, 10)
+    results = []
+    dispatcher.submit(1, lambda: 1 / 0)
+    dispatcher.submit(1, results.append, 'next')
+    wait_for(lambda: dispatcher.depth() == 0)
+    assert results == ['next']
+    assert dispatcher.latency.as_dict()['errors'] == 1
+
+
+def test_queue_size():
+    dispatcher = KeyedDispatcher('test', 1, 2)
+    release = threading.Event()
+    dispatcher.submit(1, release.wait, 5)
+    dispatcher.submit(1, release.wait, 5)
+    with pytest.raises(queue.Full):
+        dispatcher.submit(2, release.wait, 5)
+    release.set()
+    wait_for(lambda: dispatcher.depth() == 0)
+    dispatcher.submit(2, release.wait, 5)